@@ -1,13 +1,39 @@
 import os
-import shutil
-import hashlib
 import datetime
 import logging
+import time
+import threading
+from backup_cache import load_file_cache, save_file_cache, lookup_cached_hashes, update_file_cache
+from backup_pipeline import run_device_pipeline
+from backup_catalog import open_catalog, import_text_databases, add_snapshot, list_snapshot_times, \
+    iter_file_versions, write_database_entry, latest_hashes as catalog_latest_hashes, latest_hash_algorithms, \
+    latest_sources, snapshot_at, iter_snapshot_state
+from backup_store import object_path, object_temp_path, commit_object, link_object
+from backup_transfer import copy_with_hash
+from backup_walk import ExclusionMatcher, walk_files, group_by_device
+from backup_verify import verify_catalog
+from backup_chunks import store_chunked_file, iter_chunked_data, MANIFEST_SUFFIX
+from backup_watch import consume_change_journal, commit_change_journal, walk_changes
+from backup_journal import RunJournal, find_interrupted_runs, read_journal, remove_temporary_files
+from backup_pack import PackWriter, iter_pack_member
+from backup_compress import select_compression, make_compressor, iter_decompressed, object_key
+from backup_metrics import RunMetrics, append_metrics_log, profiled
+from backup_hash import LEGACY_ALGORITHM, new_hasher, hash_file as hash_source_file, hash_bytes, hash_blocks, \
+    binary_digest
+from backup_versions import BackupVersion
 # Import the configuration
 if str(os.name) == 'nt':
-    from backup_config_windows import home_dir, source_dirs, backup_base_dir, excluded_dirs
+    from backup_config_windows import home_dir, source_dirs, backup_base_dir, excluded_dirs, paranoid_mode, \
+        hash_workers, copy_workers, pipeline_queue_size, use_object_store, snapshot_links, \
+        chunk_large_files, chunk_threshold, chunk_min_size, chunk_avg_size, chunk_max_size, fused_copy, kernel_copy, \
+        use_change_journal, pack_small_files, pack_threshold, pack_max_size, \
+        compress_files, compression_rules, hash_algorithm, schedule_by_device
 else:
-    from backup_config import home_dir, source_dirs, backup_base_dir, excluded_dirs
+    from backup_config import home_dir, source_dirs, backup_base_dir, excluded_dirs, paranoid_mode, \
+        hash_workers, copy_workers, pipeline_queue_size, use_object_store, snapshot_links, \
+        chunk_large_files, chunk_threshold, chunk_min_size, chunk_avg_size, chunk_max_size, fused_copy, kernel_copy, \
+        use_change_journal, pack_small_files, pack_threshold, pack_max_size, \
+        compress_files, compression_rules, hash_algorithm, schedule_by_device
 
 # Function to check if a directory path exists and has necessary permissions
 def check_directory(path, write=False):
@@ -28,200 +54,571 @@ def check_directory(path, write=False):
         return False
     return True
 
-# Check if source and backup directories exist and have necessary permissions
-if not all(check_directory(source_dir) for source_dir in source_dirs):
-    print("Please check source directory paths and permissions.")
-    logging.error("Error: Source directory paths or permissions are invalid.")
-    exit(1)
-
-if not check_directory(backup_base_dir, write=True):
-    print("Please check backup base directory path and write permissions.")
-    logging.error("Error: Backup base directory path or write permissions are invalid.")
-    exit(1)
-
-if not check_directory(home_dir):
-    print("Please check backup base directory path and write permissions.")
-    logging.error("Error: Backup base directory path or write permissions are invalid.")
-    exit(1)
-
-# Configure the logging
-log_file = os.path.join(backup_base_dir, 'backup_log.txt')
-logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
+# Function to send log messages to backup_log.txt in the backup base directory
+def configure_logging(backup_base_dir):
+    log_file = os.path.join(backup_base_dir, 'backup_log.txt')
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
 
 # Function to list all the backed up copies of files
-def list_all_backups(backup_base_dir, check_hash):
+# With check_hash, the backup files are verified by a pool of threads; verify_latest_only limits this to
+# the latest version of each file, and other versions are left with a hash_match of None.
+def list_all_backups(backup_base_dir, check_hash, verify_workers=4, verify_bandwidth_limit=0,
+                     verify_latest_only=False):
     backup_info = {}  # Dictionary to store file information
-    backup_times = []  # List to store unique dates and times of backups
-
-    # Iterate through backup directories
-    for root, dirs, files in os.walk(backup_base_dir):
-        files.sort() # Sort files in ascending alphabetical order
-        for file in files:
-            if file.startswith("backup_database_") and file.endswith(".txt"):
-                database_file = os.path.join(root, file)
-                with open(database_file, 'r') as db:
-                    lines = db.readlines()
-
-                    # Extract date and time information from the backup database file name
-                    date_time = os.path.splitext(file)[0].split("database_")[1]  # Assuming the format is yyyy-mm-dd_hh-mm-ss
-                    # Add the unique date and time to the list
-                    if date_time not in backup_times:
-                        backup_times.append(date_time)
-
-                    i = 0
-                    while i < len(lines):
-                        # Check if the line starts with "Source: " and has at least 10 characters
-                        if lines[i].startswith("Source: ") and len(lines[i]) >= 10:
-                            source_location = lines[i].strip().split(": ")[1]
-                            i += 1
-
-                            # Check if there are enough lines in the file
-                            if i >= len(lines):
-                                break
-
-                            # Check if the line starts with "Backup: " and has at least 10 characters
-                            if lines[i].startswith("Backup: ") and len(lines[i]) >= 10:
-                                backup_file = lines[i].strip().split(": ")[1]
-
-                                # Get the actual modification time of the backup file
-                                file_mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(backup_file))
-
-                                # Get the file size from the file attributes
-                                try:
-                                    file_size = os.path.getsize(backup_file)
-                                except OSError:
-                                    # Handle cases where file size cannot be determined
-                                    file_size = 0
-                                    
-                                # Calculate the MD5 hash of the backup file using the source file path
-                                if check_hash:
-                                    calculated_md5 = calculate_backup_hash(source_location, backup_file)
-                                else:
-                                    calculated_md5 = 0
-
-                                # Check if the calculated MD5 matches the saved MD5 from the database
-                                if 'MD5 Hash' in lines[i + 1]:
-                                    saved_md5 = lines[i + 1].strip().split(": ")[1]
-                                    hash_match = calculated_md5 == saved_md5
-                                else:
-                                    hash_match = False
-
-                                # Check if the source_location is already a key in backup_info
-                                if source_location not in backup_info:
-                                    backup_info[source_location] = []
-
-                                # Append the backup file information to the list associated with source_location
-                                backup_info[source_location].append({
-                                    'backup_file': backup_file,
-                                    'mod_time': file_mod_time,
-                                    'size': file_size,
-                                    'md5_hash': saved_md5,
-                                    'hash_match': hash_match
-                                })
-
-                        i += 1
 
+    # Read the catalog, first adding any backup database files it has not seen yet
+    conn = open_catalog(backup_base_dir)
+    import_text_databases(conn, backup_base_dir)
+    backup_times = list_snapshot_times(conn)  # List of unique dates and times of backups
+
+    # Check the hashes of the backup files, skipping files verified before and unchanged since
+    if check_hash:
+        verified = verify_catalog(
+            conn,
+            lambda version, throttle: hash_backup_version(backup_base_dir, version, throttle),
+            verify_workers, verify_bandwidth_limit, verify_latest_only, backup_base_dir=backup_base_dir)
+    else:
+        verified = {}
+
+    for source_location, backup_file, saved_md5, file_size, file_mtime, date_time, storage, version_id, \
+            pack_offset, pack_length, compression, stored_size, version_algorithm in iter_file_versions(conn):
+        # Check if the calculated hash matched the saved hash from the database
+        hash_match = verified.get(version_id) if check_hash else False
+
+        # Check if the source_location is already a key in backup_info
+        versions = backup_info.get(source_location)
+        if versions is None:
+            versions = backup_info[source_location] = []
+
+        # Append the backup file information to the list associated with source_location
+        # Versions are compact records, read like dictionaries (see backup_versions)
+        versions.append(BackupVersion(backup_file, file_mtime, file_size, saved_md5, version_algorithm, hash_match,
+                                      storage, pack_offset, pack_length, compression, stored_size, date_time))
+
+    conn.close()
     return backup_info, backup_times
 
-# Function to calculate the MD5 hash of a backup file using the source file path
-def calculate_backup_hash(source_file_path, backup_file_path):
-    hasher = hashlib.md5()
-    # Include the file path in the hash
-    hasher.update(source_file_path.encode('utf-8'))  
+# Function to list the backed up copies making up the source files as of a backup run, for a point-in-time restore
+# when is a date and time in the form of the backup runs (e.g. "2023-09-18_09h44m37s"); the latest run at or before
+# it is used, or the latest run of all if when is None. With path, only the files equal to that path or inside it
+# are listed, read through the catalog's index rather than the whole history. With check_hash, only the listed
+# backup files are verified.
+# Returns the date and time of the run used (None if there is no run that early) and a list of
+# (source file, version) pairs in source file order.
+def list_backups_at(backup_base_dir, when, path=None, check_hash=False, verify_workers=4, verify_bandwidth_limit=0):
+    conn = open_catalog(backup_base_dir)
+    import_text_databases(conn, backup_base_dir)
+    date_time = snapshot_at(conn, when)
+    if date_time is None:
+        conn.close()
+        return None, []
+    rows = list(iter_snapshot_state(conn, date_time, path))
+
+    if check_hash:
+        verified = verify_catalog(
+            conn,
+            lambda version, throttle: hash_backup_version(backup_base_dir, version, throttle),
+            verify_workers, verify_bandwidth_limit, version_ids=[row[7] for row in rows],
+            backup_base_dir=backup_base_dir)
+    else:
+        verified = {}
+
+    versions = []
+    for source_location, backup_file, saved_md5, file_size, file_mtime, version_time, storage, version_id, \
+            pack_offset, pack_length, compression, stored_size, version_algorithm in rows:
+        hash_match = verified.get(version_id) if check_hash else False
+        versions.append((source_location, BackupVersion(backup_file, file_mtime, file_size, saved_md5,
+                                                        version_algorithm, hash_match, storage, pack_offset,
+                                                        pack_length, compression, stored_size, version_time)))
+    conn.close()
+    return date_time, versions
+
+# Function to read the content of a backup file in blocks, whichever way it is stored
+# Chunked files are reassembled from the chunks listed in their manifest
+# A file stored in a pack is read from its offset and length in the pack, and a compressed file is decompressed
+def iter_backup_data(backup_file_path, storage='file', backup_base_dir=None, block_size=1024 * 1024,
+                     pack_offset=None, pack_length=None, compression=None):
+    if compression:
+        yield from iter_decompressed(iter_backup_data(backup_file_path, storage, backup_base_dir, block_size,
+                                                      pack_offset, pack_length), compression)
+        return
+    if storage == 'chunked':
+        yield from iter_chunked_data(backup_base_dir, backup_file_path)
+        return
+    if storage == 'packed':
+        yield from iter_pack_member(backup_file_path, pack_offset, pack_length, block_size)
+        return
     with open(backup_file_path, 'rb') as f:
         while True:
-            data = f.read(4096)
+            data = f.read(block_size)
             if not data:
                 break
-            hasher.update(data)
-    return hasher.hexdigest()
+            yield data
 
-# Function to calculate the MD5 hash of a source file including its path
-def calculate_source_hash(file_path):
-    hasher = hashlib.md5()
+# Function to calculate the hash of a backup file using the source file path
+# throttle, if given, is called with the size of each block read (to cap the read rate)
+# hash_algorithm is the algorithm recorded for the file version (see backup_hash)
+def calculate_backup_hash(source_file_path, backup_file_path, storage='file', backup_base_dir=None, throttle=None,
+                          pack_offset=None, pack_length=None, compression=None, hash_algorithm=LEGACY_ALGORITHM):
     # Include the file path in the hash
-    hasher.update(file_path.encode('utf-8'))  
-    with open(file_path, 'rb') as f:
-        while True:
-            data = f.read(4096)
-            if not data:
-                break
-            hasher.update(data)
-    return hasher.hexdigest()
-
-# Function to build a list of MD5 hashes from existing backup database files
-def list_latest_hashes(backup_info):
-    latest_hashes = set()  # Set to store hashes of the latest backup copy of each source file
-
-    for source_location, backups in backup_info.items():
-        if backups:
-            latest_backup = backups[-1]  # Get the latest version (last entry) from the list of backups
-            md5_hash = latest_backup['md5_hash']
-            # Add the hash to the set
-            latest_hashes.add(md5_hash)
-
-    return latest_hashes
+    return hash_blocks(iter_backup_data(backup_file_path, storage, backup_base_dir, pack_offset=pack_offset,
+                                        pack_length=pack_length, compression=compression),
+                       hash_algorithm, source_file_path, throttle)
+
+# Function to calculate the hash of a backup file version as listed in the catalog
+# version is a dictionary with the source, backup_file, storage, pack_offset, pack_length, compression and
+# hash_algorithm of the file version (see verify_catalog)
+def hash_backup_version(backup_base_dir, version, throttle=None):
+    return calculate_backup_hash(version['source'], version['backup_file'], version['storage'], backup_base_dir,
+                                 throttle, version['pack_offset'], version['pack_length'], version['compression'],
+                                 version['hash_algorithm'])
+
+# Function to calculate the hash of a source file including its path
+def calculate_source_hash(file_path, hash_algorithm=LEGACY_ALGORITHM):
+    return calculate_source_hashes(file_path, hash_algorithm)[0]
+
+# Function to calculate, in one pass, the hash of a source file including its path
+# and the hash of its content alone (used as the object store key)
+def calculate_source_hashes(file_path, hash_algorithm=LEGACY_ALGORITHM):
+    # Include the file path in the first hash only
+    return hash_source_file(file_path, hash_algorithm, file_path)
+
+# Function to build a set of the hashes (as binary digests) of the latest backup copy of each source file,
+# and a dictionary of the source files whose latest copy was hashed with another algorithm than hash_algorithm
+def list_latest_hashes(backup_base_dir, hash_algorithm=LEGACY_ALGORITHM):
+    conn = open_catalog(backup_base_dir)
+    import_text_databases(conn, backup_base_dir)
+    latest_hashes = catalog_latest_hashes(conn)
+    other_algorithms = latest_hash_algorithms(conn, hash_algorithm)
+    conn.close()
+    return latest_hashes, other_algorithms
+
+# Function to find the source files backed up before that have been deleted since
+# Only the files with a latest version equal to or inside one of the paths and not seen by this run are checked.
+# A file only counts as deleted if it is gone; a file that cannot be read is not.
+def find_deleted_files(backup_base_dir, paths, seen_sources):
+    conn = open_catalog(backup_base_dir)
+    deleted = set()
+    for path in paths:
+        for source in latest_sources(conn, path):
+            if source in seen_sources:
+                continue
+            try:
+                os.lstat(source)
+            except (FileNotFoundError, NotADirectoryError):
+                deleted.add(source)
+            except OSError:
+                pass
+    conn.close()
+    return sorted(deleted)
+
+# Function to save the backup database text file of a run and record the run in the catalog
+# deleted lists the source files the run found deleted, saved as entries with just a Deleted line
+def save_backup_run(backup_base_dir, date_time, entries, deleted=()):
+    # Sort by source file so the database does not depend on the order the copies finished in
+    entries.sort(key=lambda entry: entry['source'])
+
+    # Create and save the backup database text file, replacing it in one step
+    database_file = os.path.join(backup_base_dir, f"backup_database_{date_time}.txt")
+    temp_file = database_file + '.tmp'
+    with open(temp_file, 'w') as db:
+        for entry in entries:
+            write_database_entry(db, entry)
+        for source in deleted:
+            write_database_entry(db, {'deleted': source})
+        db.flush()
+        os.fsync(db.fileno())
+    os.replace(temp_file, database_file)
+
+    # Record the run in the catalog, with the size and modification time of each file at backup time
+    conn = open_catalog(backup_base_dir)
+    add_snapshot(conn, date_time, database_file, entries, deleted)
+    conn.close()
+    return database_file
 
 # Function to perform an incremental backup
-def incremental_backup(home_dir, source_dirs, backup_base_dir, excluded_dirs):
+def incremental_backup(home_dir, source_dirs, backup_base_dir, excluded_dirs, paranoid=False,
+                       hash_workers=1, copy_workers=1, queue_size=1000, use_object_store=False,
+                       snapshot_links='hardlink', chunk_large_files=False, chunk_threshold=64 * 1024 * 1024,
+                       chunk_sizes=(256 * 1024, 1024 * 1024, 4 * 1024 * 1024), fused_copy=True,
+                       kernel_copy=True, use_change_journal=False, resume=False, pack_small_files=False,
+                       pack_threshold=64 * 1024, pack_max_size=256 * 1024 * 1024, compress_files=False,
+                       compression_rules=(), hash_algorithm='blake2b', schedule_by_device=False, metrics=None):
+    # Fail early on an unknown hash algorithm
+    new_hasher(hash_algorithm)
+    # The timings of the run are collected per phase and saved to the metrics log at the end
+    metrics = metrics or RunMetrics()
+
     # Get the current date and time as a string with second-level resolution (e.g., "2023-09-15_12-34-56")
     current_datetime = datetime.datetime.now().strftime("%Y-%m-%d_%Hh%Mm%Ss")
 
-    # Get info on previous backups without checking file hashes
-    old_backup_info, _ = list_all_backups(backup_base_dir, False)
-
-    # Build a set of existing MD5 hashes
-    latest_hashes = list_latest_hashes(old_backup_info)
-
-    # Create a list to store information about backed up files
-    backup_info = []
-
-    for source_dir in source_dirs:
-
-        for root, dirs, files in os.walk(source_dir):
-            # Exclude directories and their subdirectories based on the excluded_dirs list
-            dirs[:] = [d for d in dirs if os.path.join(root, d) not in excluded_dirs]
-
-            for file in files:
-                source_file = os.path.join(root, file)
-                relative_path = os.path.relpath(source_file, home_dir)
-
-                # Calculate the MD5 hash of the source file
-                file_hash = calculate_source_hash(source_file)
-                # Output a '.' as a progress indicator
-                print(".", end="", flush=True)  
-
-                if file_hash not in latest_hashes:
-                    # Build the backup directory structure with source directories as subdirectories
-                    backup_dir = os.path.join(backup_base_dir, current_datetime)
-                    backup_file = os.path.join(backup_dir, relative_path)
-
-                    os.makedirs(os.path.dirname(backup_file), exist_ok=True)
-                    shutil.copy2(source_file, backup_file)
-                    print(f"Backed up: {relative_path} to {backup_file}")
-
-                    # Add file information to the backup_info list
-                    backup_info.append((source_file, backup_file, file_hash))
-
-    # Create and save the backup database text file
-    database_file = os.path.join(backup_base_dir, f"backup_database_{current_datetime}.txt")
-    with open(database_file, 'w') as db:
-        for source_file, backup_file, file_hash in backup_info:
-            db.write(f"Source: {source_file}\n")
-            db.write(f"Backup: {backup_file}\n")
-            db.write(f"MD5 Hash: {file_hash}\n\n")
-
+    # Deal with runs that were interrupted: with resume, carry on with the latest one, and save the files
+    # the others had already backed up as runs of their own
+    interrupted_runs = find_interrupted_runs(backup_base_dir)
+    resumed = {}  # Source file path -> entry of a file already backed up by the resumed run
+    for date_time, journal_file in interrupted_runs:
+        entries = read_journal(journal_file)
+        remove_temporary_files(backup_base_dir, date_time)
+        if resume and date_time == interrupted_runs[-1][0]:
+            current_datetime = date_time
+            resumed = dict((entry['source'], entry) for entry in entries)
+            print(f"Resuming the backup run of {date_time}: {len(entries)} files already backed up")
+            logging.info(f"Resuming backup run {date_time}, {len(entries)} files already backed up")
+        else:
+            if entries:
+                save_backup_run(backup_base_dir, date_time, entries)
+            os.remove(journal_file)
+            print(f"Saved {len(entries)} files backed up by the interrupted run of {date_time}")
+            logging.warning(f"Saved interrupted backup run {date_time}, Number of Files: {len(entries)}")
+
+    # Build a set of existing hashes from the catalog of previous backups
+    # Files last backed up with another hash algorithm are compared using that algorithm until they change,
+    # so switching algorithms does not copy everything again
+    with metrics.phase('catalog'):
+        latest_hashes, other_algorithms = list_latest_hashes(backup_base_dir, hash_algorithm)
+
+    # Load the cache of file sizes, modification times and hashes from previous runs
+    file_cache = load_file_cache(backup_base_dir)
+    new_file_cache = {}  # Only files seen in this run are kept in the cache
+
+    # With the change watcher running, only the paths changed since the last run are visited
+    journal_session, changes = consume_change_journal(backup_base_dir) if use_change_journal else (None, None)
+    if changes is not None:
+        # Files that were not visited are still as cached, apart from the deleted ones
+        deleted_dirs = tuple(path + os.sep for path in changes['deleted'])
+        new_file_cache = dict((path, entry) for path, entry in file_cache.items()
+                              if path not in changes['deleted'] and not path.startswith(deleted_dirs))
+        print(f"Change journal: {len(changes['files'])} changed files, {len(changes['dirs'])} new directories, "
+              f"{len(changes['deleted'])} deleted paths")
+    elif use_change_journal:
+        print("Change journal not available, walking all source directories")
+    cache_lock = threading.Lock()
+    # Every source file walked by this run, so the files that were not can be checked for deletion
+    seen_sources = set()
+
+    # Hashing stage: find out whether a source file needs to be copied
+    def hash_file(walked_file):
+        # The stat result comes from the directory walk
+        source_file, file_stat = walked_file
+        seen_sources.add(source_file)
+        # A file the resumed run already backed up is skipped if it has not changed since
+        done = resumed.get(source_file)
+        if done is not None and done['size'] == file_stat.st_size and done['mtime'] == file_stat.st_mtime:
+            with cache_lock:
+                update_file_cache(new_file_cache, source_file, file_stat, (done['hash'], done['content_hash']),
+                                  done.get('hash_algorithm', LEGACY_ALGORITHM))
+            return None
+        # The algorithm the latest backup copy of the file was hashed with
+        algorithm = other_algorithms.get(source_file, hash_algorithm)
+        # Skip reading the file if its size, modification time and inode are unchanged,
+        # unless paranoid mode asks for every file to be hashed again
+        file_hashes = None if paranoid else lookup_cached_hashes(file_cache, source_file, file_stat, algorithm)
+        # Print a progress line now and then
+        metrics.progress()
+
+        if file_hashes is None:
+            is_chunked = chunk_large_files and file_stat.st_size >= chunk_threshold
+            # A cached file that has changed since the last run will most likely be copied, so hash it
+            # while copying instead of reading it twice. A file that is not in the cache may be unchanged
+            # (if there is no cache to go by) or renamed, so it is hashed first to avoid copying it, unless
+            # there are no earlier backups at all. With the object store every file is hashed first, so
+            # content that is already stored is never copied.
+            # A file last hashed with another algorithm is always hashed first, with that algorithm.
+            if algorithm == hash_algorithm:
+                if fused_copy and not paranoid and not is_chunked and not use_object_store \
+                        and (source_file in file_cache or not latest_hashes):
+                    return source_file, None, file_stat
+                # A small file to be packed is read whole and hashed before it is appended, so nothing is wasted
+                if pack_small_files and file_stat.st_size < pack_threshold:
+                    return source_file, None, file_stat
+            # Calculate the hashes of the source file with and without its path
+            hash_start = time.perf_counter()
+            file_hashes = calculate_source_hashes(source_file, algorithm)
+            metrics.add('hash', time.perf_counter() - hash_start, source_file, file_stat.st_size)
+
+        with cache_lock:
+            update_file_cache(new_file_cache, source_file, file_stat, file_hashes, algorithm)
+        if binary_digest(file_hashes[0]) in latest_hashes:
+            return None  # Unchanged since the last backup
+        if algorithm != hash_algorithm:
+            # The file has changed, and its new copy is hashed with the current algorithm
+            # (first, if it is chunked or its content may already be in the object store)
+            if not (chunk_large_files and file_stat.st_size >= chunk_threshold) and not use_object_store:
+                return source_file, None, file_stat
+            file_hashes = calculate_source_hashes(source_file, hash_algorithm)
+        return source_file, file_hashes, file_stat
+
+    # Function to copy and hash a source file into a temporary file, removing the temporary file if the copy fails
+    def copy_to_temporary_file(source_file, temp_file, compressor):
+        try:
+            return copy_with_hash(source_file, temp_file, source_file, kernel_copy, compressor, hash_algorithm)[:2]
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    # Copying stage: copy a new or modified file into this run's backup directory
+    # If the file has not been hashed yet (file_hashes is None), it is hashed as it is copied and the copy
+    # is thrown away if the file turns out to be unchanged
+    def copy_file(job):
+        source_file, file_hashes, file_stat = job
+        relative_path = os.path.relpath(source_file, home_dir)
+
+        # Build the backup directory structure with source directories as subdirectories
+        backup_dir = os.path.join(backup_base_dir, current_datetime)
+        backup_file = os.path.join(backup_dir, relative_path)
+
+        entry = {
+            'source': source_file,
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime,
+            'hash_algorithm': hash_algorithm
+        }
+
+        if chunk_large_files and file_stat.st_size >= chunk_threshold:
+            # Store a large file as content-defined chunks, so only the changed chunks are written
+            manifest_file, chunks, bytes_written, stored_hashes = store_chunked_file(
+                backup_base_dir, source_file, file_hashes, hash_algorithm, *chunk_sizes)
+            if stored_hashes != tuple(file_hashes):
+                # The file changed after it was hashed; save the hashes and size of what was actually backed up
+                print(f"Warning: {source_file} changed while it was being backed up")
+                logging.warning(f"Warning: {source_file} changed while it was being backed up")
+                entry['size'] = sum(length for _, length in chunks)
+            entry['hash'], entry['content_hash'] = stored_hashes
+            manifest_link = backup_file + MANIFEST_SUFFIX
+            if snapshot_links == 'hardlink' and link_object(manifest_file, manifest_link):
+                entry['backup_file'] = manifest_link
+            else:
+                entry['backup_file'] = manifest_file
+            entry['storage'] = 'chunked'
+            entry['chunks'] = chunks
+            print(f"Backed up: {relative_path} as {len(chunks)} chunks ({bytes_written} new bytes)")
+            return entry
+
+        if packer is not None and file_stat.st_size < pack_threshold:
+            # Append a small file to the run's pack file instead of creating a file and directories for it
+            with open(source_file, 'rb') as f:
+                data = f.read()
+            copied_hashes = hash_bytes(data, hash_algorithm, source_file)
+            if file_hashes is None:
+                with cache_lock:
+                    update_file_cache(new_file_cache, source_file, file_stat, copied_hashes, hash_algorithm)
+                if binary_digest(copied_hashes[0]) in latest_hashes:
+                    return None
+            elif copied_hashes != tuple(file_hashes):
+                print(f"Warning: {source_file} changed while it was being backed up")
+                logging.warning(f"Warning: {source_file} changed while it was being backed up")
+            entry['hash'], entry['content_hash'] = copied_hashes
+            entry['backup_file'], entry['pack_offset'] = packer.add(data)
+            entry['size'] = entry['pack_length'] = len(data)
+            entry['storage'] = 'packed'
+            print(f"Backed up: {relative_path} to {entry['backup_file']}")
+            return entry
+
+        # Compress the file if a compression rule matches it and a sample of it shrinks
+        compression = None
+        if compress_files:
+            compression = select_compression(compression_rules, source_file, file_stat.st_size)
+        compressor = make_compressor(compression) if compression else None
+
+        if use_object_store:
+            object_file = None
+            if file_hashes:
+                # The content may already be stored, compressed as this file would be or not compressed at all
+                for stored_compression in dict.fromkeys([compression, None]):
+                    candidate = object_path(backup_base_dir, object_key(file_hashes[1], stored_compression))
+                    if os.path.exists(candidate):
+                        object_file, compression = candidate, stored_compression
+                        break
+            if object_file:
+                # The content is already stored, so renamed and duplicate files cost nothing
+                copied_hashes = file_hashes
+                copied = False
+            else:
+                # Copy and hash in one pass, then store the content keyed by the hash of what was written
+                temp_file = object_temp_path(backup_base_dir)
+                copied_hashes = copy_to_temporary_file(source_file, temp_file, compressor)
+                object_file, copied = commit_object(backup_base_dir, temp_file,
+                                                    object_key(copied_hashes[1], compression))
+        else:
+            # Copy to a temporary file outside the snapshot, so no directories are created for a file
+            # that turns out to be unchanged
+            temp_file = object_temp_path(backup_base_dir)
+            copied_hashes = copy_to_temporary_file(source_file, temp_file, compressor)
+            copied = True
+
+        if file_hashes is None:
+            # The file was hashed while copying, so check now whether it has changed
+            with cache_lock:
+                update_file_cache(new_file_cache, source_file, file_stat, copied_hashes, hash_algorithm)
+            if binary_digest(copied_hashes[0]) in latest_hashes:
+                if not use_object_store:
+                    os.remove(temp_file)
+                return None
+        elif copied_hashes != tuple(file_hashes):
+            # The file changed after it was hashed; save the hashes of what was actually backed up
+            print(f"Warning: {source_file} changed while it was being backed up")
+            logging.warning(f"Warning: {source_file} changed while it was being backed up")
+        entry['hash'], entry['content_hash'] = copied_hashes
+
+        if use_object_store:
+            entry['storage'] = 'object'
+            if snapshot_links == 'hardlink' and link_object(object_file, backup_file):
+                entry['backup_file'] = backup_file
+            else:
+                entry['backup_file'] = object_file
+            if copied:
+                print(f"Backed up: {relative_path} to {entry['backup_file']}")
+            else:
+                print(f"Backed up: {relative_path} (content already stored)")
+        else:
+            os.makedirs(os.path.dirname(backup_file), exist_ok=True)
+            os.replace(temp_file, backup_file)
+            entry['backup_file'] = backup_file
+            print(f"Backed up: {relative_path} to {backup_file}")
+
+        if compression:
+            # Record the size of the file as stored as well as its own size
+            entry['compression'] = compression
+            entry['raw_size'] = file_stat.st_size
+            entry['stored_size'] = os.path.getsize(entry['backup_file'])
+
+        return entry
+
+    # Walk, hash and copy concurrently
+    # Excluded directories and patterns are compiled once, and excluded directories are never entered
+    matcher = ExclusionMatcher(excluded_dirs)
+    if changes is not None:
+        walks = {None: walk_changes(changes, matcher, walk_files)}
+    elif schedule_by_device:
+        # Source directories on different devices are walked and hashed at the same time
+        walks = dict((device, walk_files(device_dirs, matcher))
+                     for device, device_dirs in group_by_device(source_dirs).items())
+    else:
+        walks = {None: walk_files(source_dirs, matcher)}
+    walks = dict((device, metrics.timed_iter('walk', walked_files)) for device, walked_files in walks.items())
+    # Each copied file is recorded in the run's journal as soon as it is complete, so an interrupted run
+    # can be resumed, or at least its copies are not lost
+    journal = RunJournal(backup_base_dir, current_datetime)
+    # Small files are appended to pack files as they are copied
+    packer = PackWriter(backup_base_dir, current_datetime, pack_max_size) if pack_small_files else None
+
+    def copy_and_record(job):
+        copy_start = time.perf_counter()
+        entry = copy_file(job)
+        # Copies thrown away because the file was unchanged still count, as the file was read
+        metrics.add('copy', time.perf_counter() - copy_start, job[0], job[2].st_size)
+        metrics.progress()
+        if entry is not None:
+            journal.append(entry)
+        return entry
+
+    try:
+        backup_info, errors = run_device_pipeline(walks, hash_file, copy_and_record,
+                                                  hash_workers, copy_workers, queue_size)
+    finally:
+        if packer is not None:
+            packer.close()
+        journal.close()
+
+    # Files backed up before the run was resumed, unless they have been backed up again since
+    copied_sources = set(entry['source'] for entry in backup_info)
+    backup_info += [entry for source, entry in resumed.items() if source not in copied_sources]
+
+    with metrics.phase('save', len(backup_info)):
+        # Record the files deleted since the last run, so a restore to this run leaves them out.
+        # A missing source directory (such as an unmounted drive) is not taken as its files being deleted.
+        if changes is not None:
+            deleted = find_deleted_files(backup_base_dir, changes['deleted'], seen_sources)
+        else:
+            deleted = find_deleted_files(backup_base_dir, [path for path in source_dirs if os.path.isdir(path)],
+                                         seen_sources)
+        database_file = save_backup_run(backup_base_dir, current_datetime, backup_info, deleted)
+        os.remove(journal.path)
+
+        # Save the file cache only once the backup database is safely written
+        save_file_cache(backup_base_dir, new_file_cache)
+    metrics.progress(force=True)
+
+    if deleted:
+        print(f"{len(deleted)} files deleted since the last backup")
     print(f"\nBackup database saved to: {database_file}")
 
+    # Changes up to the start of this run are now backed up; a run with errors walks everything next time
+    if journal_session is not None and not errors:
+        commit_change_journal(backup_base_dir, journal_session)
+
     # Log the date and number of files included in the backup
     num_files_in_backup = len(backup_info)
-    logging.info(f"Backup Date/Time: {current_datetime}, Number of Files: {num_files_in_backup}")
+    logging.info(f"Backup Date/Time: {current_datetime}, Number of Files: {num_files_in_backup}, "
+                 f"Number of Deleted Files: {len(deleted)}")
+    if errors:
+        logging.error(f"Backup Date/Time: {current_datetime}, Number of Errors: {len(errors)}")
+
+    # Append the timings of the run to the metrics log
+    summary = metrics.summary(kind='backup', date_time=current_datetime, files_in_backup=num_files_in_backup,
+                              files_deleted=len(deleted), errors=len(errors))
+    append_metrics_log(backup_base_dir, summary)
+    logging.info(f"Backup Date/Time: {current_datetime}, Timings: " +
+                 ", ".join(f"{phase} {counters['files']} files in {counters['wall_seconds']} s"
+                           for phase, counters in summary['phases'].items()))
+    return summary
+
+# Function to get the keyword arguments for incremental_backup from the configuration
+def configured_options():
+    return dict(paranoid=paranoid_mode, hash_workers=hash_workers, copy_workers=copy_workers,
+                queue_size=pipeline_queue_size, use_object_store=use_object_store, snapshot_links=snapshot_links,
+                chunk_large_files=chunk_large_files, chunk_threshold=chunk_threshold,
+                chunk_sizes=(chunk_min_size, chunk_avg_size, chunk_max_size), fused_copy=fused_copy,
+                kernel_copy=kernel_copy, use_change_journal=use_change_journal, pack_small_files=pack_small_files,
+                pack_threshold=pack_threshold, pack_max_size=pack_max_size, compress_files=compress_files,
+                compression_rules=compression_rules, hash_algorithm=hash_algorithm,
+                schedule_by_device=schedule_by_device)
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Back up the source directories incrementally.")
+    parser.add_argument('--resume', action='store_true',
+                        help="carry on with the last interrupted backup run instead of starting a new one")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the run with cProfile and save the statistics in the backup base directory")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="trace memory allocations with tracemalloc and print the peak and top allocations")
+    args = parser.parse_args()
+
+    # Check if source and backup directories exist and have necessary permissions
+    if not all(check_directory(source_dir) for source_dir in source_dirs):
+        print("Please check source directory paths and permissions.")
+        logging.error("Error: Source directory paths or permissions are invalid.")
+        exit(1)
+
+    if not check_directory(backup_base_dir, write=True):
+        print("Please check backup base directory path and write permissions.")
+        logging.error("Error: Backup base directory path or write permissions are invalid.")
+        exit(1)
+
+    if not check_directory(home_dir):
+        print("Please check backup base directory path and write permissions.")
+        logging.error("Error: Backup base directory path or write permissions are invalid.")
+        exit(1)
+
+    configure_logging(backup_base_dir)
+
     start_time = datetime.datetime.now()
 
-    incremental_backup(home_dir, source_dirs, backup_base_dir, excluded_dirs)
+    profile_prefix = os.path.join(backup_base_dir, start_time.strftime("backup_profile_%Y-%m-%d_%Hh%Mm%Ss"))
+    with profiled(profile_prefix, args.profile, args.trace_memory):
+        summary = incremental_backup(home_dir, source_dirs, backup_base_dir, excluded_dirs, resume=args.resume,
+                                     **configured_options())
+
+    # Print the throughput of each phase and the slowest files
+    for phase, counters in summary['phases'].items():
+        print(f"{phase}: {counters['files']} files, {counters['bytes'] / 1e6:.1f} MB in {counters['wall_seconds']} s "
+              f"({counters['files_per_second']} files/s, {counters['mb_per_second']} MB/s)")
+    for slow in summary['slowest_files']:
+        print(f"Slow {slow['phase']}: {slow['file']} ({slow['seconds']} s)")
 
     end_time = datetime.datetime.now()
     run_time = (end_time - start_time).total_seconds()
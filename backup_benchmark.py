@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import datetime
+import contextlib
+import tracemalloc
+
+# Default shape of the synthetic source tree
+DEFAULT_FILE_COUNT = 2000
+DEFAULT_MEDIAN_SIZE = 16 * 1024
+DEFAULT_SIZE_SIGMA = 1.5
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+DEFAULT_DEPTH = 3
+DEFAULT_FANOUT = 4
+DEFAULT_TEXT_FRACTION = 0.3
+DEFAULT_CHANGE_PERCENTS = [1, 10]
+
+# A slowdown of more than this percentage is flagged by the compare mode
+DEFAULT_THRESHOLD_PERCENT = 10
+
+# Modification times of generated files start here, well in the past, so the file cache trusts them
+BASE_MTIME = 1600000000
+
+# Words used to make compressible text files
+_WORDS = ("backup restore catalog object chunk pack journal snapshot source file directory hash verify "
+          "prune copy stream buffer thread queue cache index record size time path").split()
+
+# Function to generate the content of one file
+def _file_content(rng, size, is_text):
+    if not is_text:
+        return rng.randbytes(size)
+    text = bytearray()
+    while len(text) < size:
+        text += (' '.join(rng.choice(_WORDS) for _ in range(12)) + '\n').encode('ascii')
+    return bytes(text[:size])
+
+# Function to pick a file size from a log-normal distribution, as file sizes in real trees roughly follow
+def _file_size(rng, median_size, size_sigma, max_size):
+    return min(int(rng.lognormvariate(math.log(median_size), size_sigma)), max_size)
+
+# Function to pick a directory for a new file, depth levels down a tree with fanout subdirectories per level
+def _directory_for(rng, root, depth, fanout):
+    parts = [f"dir{rng.randrange(fanout)}" for _ in range(rng.randint(0, depth))]
+    return os.path.join(root, *parts)
+
+# Function to write one file with a given modification time
+def _write_file(path, data, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, (mtime, mtime))
+
+# Function to generate a reproducible synthetic source tree
+# The same parameters and seed always give the same tree. Returns the list of generated file paths.
+def generate_tree(root, file_count=DEFAULT_FILE_COUNT, median_size=DEFAULT_MEDIAN_SIZE,
+                  size_sigma=DEFAULT_SIZE_SIGMA, max_size=DEFAULT_MAX_SIZE, depth=DEFAULT_DEPTH,
+                  fanout=DEFAULT_FANOUT, text_fraction=DEFAULT_TEXT_FRACTION, seed=1):
+    rng = random.Random(seed)
+    files = []
+    for i in range(file_count):
+        is_text = rng.random() < text_fraction
+        path = os.path.join(_directory_for(rng, root, depth, fanout), f"file{i}{'.txt' if is_text else '.bin'}")
+        _write_file(path, _file_content(rng, _file_size(rng, median_size, size_sigma, max_size), is_text),
+                    BASE_MTIME + i)
+        files.append(path)
+    return files
+
+# Function to simulate the changes made between two backups: of change_percent of the files,
+# most are modified, some are new and some are deleted. Returns the updated list of files.
+def apply_churn(root, files, change_percent, run_number, median_size=DEFAULT_MEDIAN_SIZE,
+                size_sigma=DEFAULT_SIZE_SIGMA, max_size=DEFAULT_MAX_SIZE, depth=DEFAULT_DEPTH,
+                fanout=DEFAULT_FANOUT, text_fraction=DEFAULT_TEXT_FRACTION, seed=1):
+    rng = random.Random(seed * 1000 + run_number)
+    count = max(1, round(len(files) * change_percent / 100))
+    mtime = BASE_MTIME + 10000000 * run_number
+    files = list(files)
+
+    num_new = count // 5
+    num_deleted = count // 10
+    for i, path in enumerate(rng.sample(files, count - num_new - num_deleted)):
+        is_text = path.endswith('.txt')
+        _write_file(path, _file_content(rng, _file_size(rng, median_size, size_sigma, max_size), is_text), mtime + i)
+    for path in rng.sample(files, num_deleted):
+        os.remove(path)
+        files.remove(path)
+    for i in range(num_new):
+        is_text = rng.random() < text_fraction
+        path = os.path.join(_directory_for(rng, root, depth, fanout),
+                            f"new{run_number}_{i}{'.txt' if is_text else '.bin'}")
+        _write_file(path, _file_content(rng, _file_size(rng, median_size, size_sigma, max_size), is_text), mtime + i)
+        files.append(path)
+    return files
+
+# Function to measure the total size of the files in a list
+def _total_size(files):
+    return sum(os.path.getsize(path) for path in files)
+
+# Function to wait for the next second, so two backup runs never share a date and time
+def _next_second():
+    time.sleep(1.05 - (time.time() % 1))
+
+# Function to time one benchmark step, returning its result and a result dictionary for the report
+def _timed(step, num_files=None, num_bytes=None):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        value = step()
+    seconds = time.perf_counter() - start
+    result = {'seconds': round(seconds, 4)}
+    if num_files is not None:
+        result['files'] = num_files
+        result['files_per_second'] = round(num_files / max(seconds, 1e-9), 1)
+    if num_bytes is not None:
+        result['bytes'] = num_bytes
+        result['mb_per_second'] = round(num_bytes / max(seconds, 1e-9) / 1e6, 2)
+    return value, result
+
+# Function to run the whole benchmark in a work directory
+# Returns the report dictionary
+def run_benchmark(work_dir, file_count=DEFAULT_FILE_COUNT, median_size=DEFAULT_MEDIAN_SIZE,
+                  size_sigma=DEFAULT_SIZE_SIGMA, max_size=DEFAULT_MAX_SIZE, depth=DEFAULT_DEPTH,
+                  fanout=DEFAULT_FANOUT, text_fraction=DEFAULT_TEXT_FRACTION,
+                  change_percents=DEFAULT_CHANGE_PERCENTS, seed=1):
+    import backup
+    import restore
+    from backup_catalog import open_catalog
+    from backup_verify import verify_catalog
+
+    # Keep the benchmark runs out of the real backup log
+    logging.disable(logging.WARNING)
+
+    home = os.path.join(work_dir, 'home')
+    source = os.path.join(home, 'source')
+    backup_base = os.path.join(work_dir, 'backup')
+    restore_base = os.path.join(work_dir, 'restore')
+    for directory in (source, backup_base, restore_base):
+        os.makedirs(directory)
+    tree = dict(median_size=median_size, size_sigma=size_sigma, max_size=max_size, depth=depth, fanout=fanout,
+                text_fraction=text_fraction, seed=seed)
+
+    print(f"Generating {file_count} files in {source}...")
+    files = generate_tree(source, file_count, **tree)
+    total_bytes = _total_size(files)
+    print(f"Generated {total_bytes / 1e6:.1f} MB.")
+
+    options = backup.configured_options()
+    options['use_change_journal'] = False  # The change watcher is not watching the synthetic tree
+
+    def run_backup():
+        backup.incremental_backup(home, [source], backup_base, [], **options)
+
+    results = {}
+    print("Timing the full backup...")
+    _next_second()
+    _, results['full_backup'] = _timed(run_backup, len(files), total_bytes)
+    print("Timing a backup with no changes...")
+    _next_second()
+    _, results['no_change_backup'] = _timed(run_backup, len(files), total_bytes)
+    for run_number, change_percent in enumerate(change_percents, 1):
+        files = apply_churn(source, files, change_percent, run_number, **tree)
+        print(f"Timing a backup with {change_percent:g}% of the files changed...")
+        _next_second()
+        _, results[f'change_{change_percent:g}pct_backup'] = _timed(run_backup, len(files), _total_size(files))
+
+    print("Timing the catalog load...")
+    backup_info, results['catalog_load'] = _timed(lambda: backup.list_all_backups(backup_base, False)[0])
+    num_versions = sum(len(versions) for versions in backup_info.values())
+    results['catalog_load']['files'] = num_versions
+    results['catalog_load']['files_per_second'] = round(num_versions / max(results['catalog_load']['seconds'],
+                                                                           1e-9), 1)
+
+    # Measure the memory taken by the loaded catalog and the set of latest hashes, in a separate load
+    # so that tracing the allocations does not slow down the timed one
+    print("Measuring the catalog memory...")
+    del backup_info
+    tracemalloc.start()
+    backup_info = backup.list_all_backups(backup_base, False)[0]
+    catalog_memory, catalog_peak = tracemalloc.get_traced_memory()
+    latest_hashes = backup.list_latest_hashes(backup_base)[0]
+    hashes_memory = tracemalloc.get_traced_memory()[0] - catalog_memory
+    tracemalloc.stop()
+    del latest_hashes
+    results['catalog_load']['memory_bytes'] = catalog_memory
+    results['catalog_load']['peak_memory_bytes'] = catalog_peak
+    results['catalog_load']['bytes_per_version'] = round(catalog_memory / max(num_versions, 1), 1)
+    results['catalog_load']['latest_hashes_bytes'] = hashes_memory
+
+    def verify_all():
+        conn = open_catalog(backup_base)
+        verified = verify_catalog(
+            conn,
+            lambda version, throttle: backup.hash_backup_version(backup_base, version, throttle),
+            restore.verify_workers, force=True, backup_base_dir=backup_base)
+        conn.close()
+        return verified
+    print("Timing hash verification...")
+    stored_bytes = sum(version['size'] for versions in backup_info.values() for version in versions)
+    verified, results['verify'] = _timed(verify_all, num_versions, stored_bytes)
+    results['verify']['failed'] = sum(1 for hash_match in verified.values() if not hash_match)
+
+    latest = restore.select_latest_versions(backup_info)
+    restored_bytes = sum(version['size'] for _, version in latest)
+    print("Timing the restore...")
+    counts, results['restore'] = _timed(
+        lambda: restore.restore_files(latest, backup_base, home, restore_base, restore.restore_workers),
+        len(latest), restored_bytes)
+    results['restore']['failed'] = counts['failed']
+    print("Timing the restore script generation...")
+    _, results['restore_script'] = _timed(
+        lambda: restore.generate_restore_script(backup_info, os.path.join(work_dir, 'restore_backup.sh'),
+                                                home, restore_base), len(latest))
+
+    logging.disable(logging.NOTSET)
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'parameters': dict(file_count=file_count, change_percents=list(change_percents), **tree),
+        'options': dict((key, value) for key, value in options.items() if key != 'compression_rules'),
+        'results': results,
+    }
+
+# Function to compare two benchmark reports
+# Returns a list of (step, old seconds, new seconds, change in percent, slower) for the steps in both
+def compare_reports(old_report, new_report, threshold_percent=DEFAULT_THRESHOLD_PERCENT):
+    rows = []
+    for step, new_result in new_report['results'].items():
+        old_result = old_report['results'].get(step)
+        if old_result is None:
+            continue
+        old_seconds, new_seconds = old_result['seconds'], new_result['seconds']
+        change = (new_seconds - old_seconds) / max(old_seconds, 1e-9) * 100
+        rows.append((step, old_seconds, new_seconds, change, change > threshold_percent))
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark backup, catalog load, verification and restore "
+                                                 "on a synthetic source tree.")
+    parser.add_argument('--files', type=int, default=DEFAULT_FILE_COUNT, help="number of files to generate")
+    parser.add_argument('--median-size', type=int, default=DEFAULT_MEDIAN_SIZE, help="median file size in bytes")
+    parser.add_argument('--size-sigma', type=float, default=DEFAULT_SIZE_SIGMA,
+                        help="spread of the log-normal file size distribution")
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_SIZE, help="largest file size in bytes")
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help="maximum directory depth")
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT, help="subdirectories per directory")
+    parser.add_argument('--text-fraction', type=float, default=DEFAULT_TEXT_FRACTION,
+                        help="fraction of compressible text files")
+    parser.add_argument('--change', type=float, nargs='+', default=DEFAULT_CHANGE_PERCENTS,
+                        help="percentage of files changed before each further backup")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the synthetic tree")
+    parser.add_argument('--work-dir', help="directory to create the tree and backups in (default: the system "
+                                           "temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="keep the work directory afterwards")
+    parser.add_argument('--output', help="JSON report file (default: benchmark_<date and time>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two JSON report files")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD_PERCENT,
+                        help="slowdown in percent flagged by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old_report = json.load(f)
+        with open(args.compare[1]) as f:
+            new_report = json.load(f)
+        rows = compare_reports(old_report, new_report, args.threshold)
+        print(f"{'Step':<28}{'Old (s)':>10}{'New (s)':>10}{'Change':>10}")
+        for step, old_seconds, new_seconds, change, slower in rows:
+            flag = '  SLOWER' if slower else ''
+            print(f"{step:<28}{old_seconds:>10.3f}{new_seconds:>10.3f}{change:>+9.1f}%{flag}")
+        num_slower = sum(1 for row in rows if row[4])
+        print(f"{num_slower} of {len(rows)} steps slower by more than {args.threshold:g}%.")
+        sys.exit(1 if num_slower else 0)
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='backup_benchmark_', dir=args.work_dir)
+    try:
+        report = run_benchmark(work_dir, args.files, args.median_size, args.size_sigma, args.max_size, args.depth,
+                               args.fanout, args.text_fraction, args.change, args.seed)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output_file = args.output or f"benchmark_{datetime.datetime.now().strftime('%Y-%m-%d_%Hh%Mm%Ss')}.json"
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    for step, result in report['results'].items():
+        print(f"{step:<28}{result['seconds']:>10.3f} s")
+    catalog_load = report['results']['catalog_load']
+    print(f"Catalog memory: {catalog_load['memory_bytes'] / 1e6:.1f} MB for {catalog_load['files']} versions "
+          f"({catalog_load['bytes_per_version']} bytes per version), latest hashes "
+          f"{catalog_load['latest_hashes_bytes'] / 1e6:.1f} MB")
+    print(f"Benchmark report saved to: {output_file}")
@@ -0,0 +1,64 @@
+import os
+import json
+import time
+
+from backup_hash import LEGACY_ALGORITHM
+
+# Name of the file metadata cache, saved alongside the backup database files
+CACHE_FILE_NAME = 'backup_file_cache.txt'
+
+# Files modified this recently are not cached, because a further change within the
+# same timestamp tick would not alter the stat signature
+MIN_CACHE_AGE_SECONDS = 2
+
+# Function to build the stat signature used to decide whether a file has changed
+def stat_signature(stat_result):
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, stat_result.st_dev)
+
+# Function to load the file metadata cache from the backup base directory
+def load_file_cache(backup_base_dir):
+    cache = {}  # Dictionary of source file path -> (stat signature, (path hash, content hash), hash algorithm)
+    cache_file = os.path.join(backup_base_dir, CACHE_FILE_NAME)
+    if not os.path.exists(cache_file):
+        return cache
+
+    with open(cache_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                fields = json.loads(line)
+                # Lines saved before the algorithm was recorded hold MD5 hashes
+                if len(fields) == 7:
+                    fields.append(LEGACY_ALGORITHM)
+                path, size, mtime_ns, inode, device, path_hash, content_hash, algorithm = fields
+            except ValueError:
+                continue  # Ignore damaged or old format lines, those files will simply be hashed again
+            cache[path] = ((size, mtime_ns, inode, device), (path_hash, content_hash), algorithm)
+
+    return cache
+
+# Function to return the cached hashes of a file, or None if the file has to be read
+# Hashes made with another algorithm than the one asked for are no use, so the file is read again
+def lookup_cached_hashes(cache, file_path, stat_result, algorithm=LEGACY_ALGORITHM):
+    entry = cache.get(file_path)
+    if entry is None:
+        return None
+    signature, file_hashes, cached_algorithm = entry
+    if signature != stat_signature(stat_result) or cached_algorithm != algorithm:
+        return None
+    return file_hashes
+
+# Function to record the hashes of a file against its current stat signature
+def update_file_cache(cache, file_path, stat_result, file_hashes, algorithm=LEGACY_ALGORITHM):
+    if time.time() - stat_result.st_mtime < MIN_CACHE_AGE_SECONDS:
+        cache.pop(file_path, None)
+        return
+    cache[file_path] = (stat_signature(stat_result), tuple(file_hashes), algorithm)
+
+# Function to save the file metadata cache, replacing the old cache file atomically
+def save_file_cache(backup_base_dir, cache):
+    cache_file = os.path.join(backup_base_dir, CACHE_FILE_NAME)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        for path, (signature, file_hashes, algorithm) in cache.items():
+            f.write(json.dumps([path] + list(signature) + list(file_hashes) + [algorithm]) + '\n')
+    os.replace(temp_file, cache_file)
@@ -0,0 +1,432 @@
+import os
+import sqlite3
+import datetime
+
+from backup_store import object_path
+from backup_chunks import read_manifest
+from backup_compress import object_key
+from backup_hash import LEGACY_ALGORITHM, binary_digest
+
+# Name of the catalog database, saved alongside the backup database text files
+CATALOG_FILE_NAME = 'backup_catalog.db'
+
+# Tables for backup runs (snapshots) and the file versions saved in each run.
+# latest_versions holds one row per source file so the latest version is a single indexed lookup; a file
+# deleted from the source directories is dropped from it. deletions records the run that first found each
+# source file gone. Each file version records in superseded_at the run of the next version or deletion of its file
+# (NULL while it is current), so the state of the source directories at any run is an indexed lookup of the
+# versions saved at or before the run and superseded after it (see iter_snapshot_state).
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    date_time TEXT NOT NULL UNIQUE,
+    database_file TEXT
+);
+CREATE TABLE IF NOT EXISTS file_versions (
+    id INTEGER PRIMARY KEY,
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots(id),
+    source TEXT NOT NULL,
+    backup_file TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash TEXT,
+    storage TEXT,
+    pack_offset INTEGER,
+    pack_length INTEGER,
+    compression TEXT,
+    stored_size INTEGER,
+    hash_algorithm TEXT,
+    superseded_at TEXT
+);
+CREATE INDEX IF NOT EXISTS file_versions_source ON file_versions(source, snapshot_id);
+CREATE INDEX IF NOT EXISTS file_versions_superseded ON file_versions(superseded_at);
+CREATE INDEX IF NOT EXISTS file_versions_snapshot ON file_versions(snapshot_id);
+CREATE TABLE IF NOT EXISTS latest_versions (
+    source TEXT PRIMARY KEY,
+    version_id INTEGER NOT NULL REFERENCES file_versions(id),
+    hash TEXT NOT NULL,
+    date_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS latest_versions_hash ON latest_versions(hash);
+CREATE TABLE IF NOT EXISTS deletions (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots(id),
+    source TEXT NOT NULL,
+    PRIMARY KEY (source, snapshot_id)
+);
+CREATE INDEX IF NOT EXISTS deletions_snapshot ON deletions(snapshot_id);
+CREATE TABLE IF NOT EXISTS chunks (
+    version_id INTEGER NOT NULL REFERENCES file_versions(id),
+    seq INTEGER NOT NULL,
+    chunk_hash TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (version_id, seq)
+);
+CREATE TABLE IF NOT EXISTS verifications (
+    version_id INTEGER PRIMARY KEY REFERENCES file_versions(id),
+    hash_match INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    verified_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL
+);
+'''
+
+# Columns added to the tables after the first release, with their types
+ADDED_COLUMNS = {
+    'file_versions': [('content_hash', 'TEXT'), ('storage', 'TEXT'), ('pack_offset', 'INTEGER'),
+                      ('pack_length', 'INTEGER'), ('compression', 'TEXT'), ('stored_size', 'INTEGER'),
+                      ('hash_algorithm', 'TEXT'), ('superseded_at', 'TEXT')],
+}
+
+# Function to open (and create if needed) the catalog in the backup base directory
+def open_catalog(backup_base_dir):
+    conn = sqlite3.connect(os.path.join(backup_base_dir, CATALOG_FILE_NAME))
+    added = add_missing_columns(conn)
+    conn.executescript(CATALOG_SCHEMA)
+    if ('file_versions', 'superseded_at') in added:
+        fill_superseded_times(conn)
+    return conn
+
+# Function to upgrade a catalog made by an older version of the scripts
+# Returns the list of (table, column) added
+def add_missing_columns(conn):
+    added = []
+    for table, columns in ADDED_COLUMNS.items():
+        existing = set(row[1] for row in conn.execute(f"PRAGMA table_info({table})"))
+        if not existing:
+            continue  # New catalog, the table is created with all its columns
+        for column, column_type in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                added.append((table, column))
+    return added
+
+# Function to set superseded_at of every file version from the versions and deletions that follow it
+def fill_superseded_times(conn):
+    updates = []
+    previous = None
+    for source, date_time, is_deletion, event_id, snapshot_id, superseded_at in iter_source_events(conn):
+        if previous is not None and previous[0] == source and not previous[2]:
+            updates.append((date_time, previous[3]))
+        previous = (source, date_time, is_deletion, event_id)
+    with conn:
+        conn.executemany("UPDATE file_versions SET superseded_at = ? WHERE id = ?", updates)
+
+# Function to list the versions and deletions of every source file, in source file and date order:
+# (source, date and time, 1 for a deletion or 0 for a version, version id or deletion rowid, snapshot id,
+# superseded_at of the version)
+def iter_source_events(conn):
+    return conn.execute(
+        "SELECT v.source, s.date_time, 0, v.id, v.snapshot_id, v.superseded_at FROM file_versions v "
+        "JOIN snapshots s ON s.id = v.snapshot_id "
+        "UNION ALL SELECT d.source, s.date_time, 1, d.rowid, d.snapshot_id, NULL FROM deletions d "
+        "JOIN snapshots s ON s.id = d.snapshot_id ORDER BY 1, 2, 3, 4")
+
+# Function to extract the date and time from a backup database file name
+def database_date_time(file_name):
+    # Assuming the format is backup_database_yyyy-mm-dd_hh-mm-ss.txt
+    return os.path.splitext(file_name)[0].split("database_")[1]
+
+# Function to turn a backup run (e.g. "2023-09-18_09h44m37s") or a date and time such as "2023-09-18 09:44" or
+# "2023-09-18T09:44:37" into a date and time in the form of the backup runs, raising ValueError if it is neither.
+# A date on its own means the end of that day.
+def parse_point_in_time(when):
+    try:
+        return datetime.datetime.strptime(when, "%Y-%m-%d_%Hh%Mm%Ss").strftime("%Y-%m-%d_%Hh%Mm%Ss")
+    except ValueError:
+        pass
+    try:
+        point_in_time = datetime.datetime.fromisoformat(when)
+    except ValueError:
+        raise ValueError(f"not a backup run or a date and time: {when!r}") from None
+    if len(when) == len("YYYY-MM-DD"):
+        point_in_time = point_in_time.replace(hour=23, minute=59, second=59)
+    return point_in_time.strftime("%Y-%m-%d_%Hh%Mm%Ss")
+
+# Names of the fields in a backup database text file entry, and the catalog entry keys they map to
+# The 'MD5 Hash' field keeps its name for older readers, but holds a hash made with the algorithm in
+# 'Hash Algorithm' (MD5 if there is none)
+DATABASE_FIELDS = {
+    'Source': 'source',
+    'Backup': 'backup_file',
+    'MD5 Hash': 'hash',
+    'Hash Algorithm': 'hash_algorithm',
+    'Content Hash': 'content_hash',
+    'Storage': 'storage',
+    'Pack Offset': 'pack_offset',
+    'Pack Length': 'pack_length',
+    'Compression': 'compression',
+    'Raw Size': 'raw_size',
+    'Deleted': 'deleted',
+}
+
+# Function to write one entry to a backup database text file
+def write_database_entry(db, entry):
+    for field, key in DATABASE_FIELDS.items():
+        if entry.get(key) is not None:
+            db.write(f"{field}: {entry[key]}\n")
+    db.write("\n")
+
+# Function to read the entries from a backup database text file
+# Entries are blank line separated blocks of "Field: value" lines, starting with Source and Backup.
+# A source file found deleted by the run is a block with just a Deleted line.
+# Returns the list of entries and the list of deleted source files.
+def read_text_database(database_file):
+    entries = []
+    entry = {}
+    with open(database_file, 'r') as db:
+        for line in db:
+            line = line.rstrip('\n')
+            field, separator, value = line.partition(": ")
+            if separator and field in DATABASE_FIELDS:
+                if field == 'Source' and entry:
+                    entries.append(entry)  # Entry without a blank line after it
+                    entry = {}
+                entry[DATABASE_FIELDS[field]] = value.strip()
+            elif not line.strip() and entry:
+                entries.append(entry)
+                entry = {}
+    if entry:
+        entries.append(entry)
+
+    # Only keep complete entries
+    deleted = [e['deleted'] for e in entries if e.get('deleted')]
+    return [e for e in entries if e.get('source') and e.get('backup_file')], deleted
+
+# Function to record a backup run and its file versions in the catalog
+# Each entry is a dictionary with the source file, backup file, hash, size and modification time,
+# and optionally the content hash and storage. Files in the object store have their storage set to 'object';
+# chunked files have it set to 'chunked' and a list of (chunk hash, length) in 'chunks'; small files
+# appended to a pack file have it set to 'packed', with their place in the pack in 'pack_offset' and 'pack_length'.
+# Compressed files have the codec in 'compression' and the size of the compressed backup file in 'stored_size'.
+# The hash algorithm is in 'hash_algorithm', and entries without one were hashed with MD5.
+# deleted lists the source files the run found deleted since their latest version.
+def add_snapshot(conn, date_time, database_file, entries, deleted=()):
+    with conn:
+        # A second run within the same second adds its files to the existing snapshot
+        conn.execute("INSERT OR IGNORE INTO snapshots (date_time, database_file) VALUES (?, ?)",
+                     (date_time, database_file))
+        snapshot_id = conn.execute("SELECT id FROM snapshots WHERE date_time = ?", (date_time,)).fetchone()[0]
+        for entry in entries:
+            source = entry['source']
+            file_hash = entry.get('hash', '')
+            cursor = conn.execute(
+                "INSERT INTO file_versions (snapshot_id, source, backup_file, hash, size, mtime, content_hash, storage, "
+                "pack_offset, pack_length, compression, stored_size, hash_algorithm) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (snapshot_id, source, entry['backup_file'], file_hash, entry['size'], entry['mtime'],
+                 entry.get('content_hash'), entry.get('storage'), entry.get('pack_offset'), entry.get('pack_length'),
+                 entry.get('compression'), entry.get('stored_size', entry['size']),
+                 entry.get('hash_algorithm') or LEGACY_ALGORITHM))
+            version_id = cursor.lastrowid
+            # A file found deleted by an earlier run in the same second is back
+            conn.execute("DELETE FROM deletions WHERE snapshot_id = ? AND source = ?", (snapshot_id, source))
+            # The new version supersedes the versions of the file current at this run, and is superseded by the
+            # next version or deletion of the file if a later run was recorded first
+            conn.execute(
+                "UPDATE file_versions SET superseded_at = ? WHERE source = ? AND id < ? "
+                "AND (superseded_at IS NULL OR superseded_at > ?) "
+                "AND (SELECT date_time FROM snapshots WHERE id = snapshot_id) <= ?",
+                (date_time, source, version_id, date_time, date_time))
+            conn.execute(
+                "UPDATE file_versions SET superseded_at = (SELECT MIN(s.date_time) FROM ("
+                "SELECT snapshot_id FROM file_versions WHERE source = ? "
+                "UNION ALL SELECT snapshot_id FROM deletions WHERE source = ?) e "
+                "JOIN snapshots s ON s.id = e.snapshot_id WHERE s.date_time > ?) WHERE id = ?",
+                (source, source, date_time, version_id))
+            # Only replace the latest version with a version from a later (or the same) run,
+            # and not if the file was deleted later
+            conn.execute(
+                "INSERT OR REPLACE INTO latest_versions (source, version_id, hash, date_time) "
+                "SELECT ?, ?, ?, ? WHERE NOT EXISTS "
+                "(SELECT 1 FROM latest_versions WHERE source = ? AND date_time > ?) AND NOT EXISTS "
+                "(SELECT 1 FROM deletions d JOIN snapshots s ON s.id = d.snapshot_id "
+                "WHERE d.source = ? AND s.date_time > ?)",
+                (source, version_id, file_hash, date_time, source, date_time, source, date_time))
+            # Count the references to each stored object, so unused objects can be pruned later
+            if entry.get('storage') == 'object':
+                add_object_reference(conn, object_key(entry['content_hash'], entry.get('compression')),
+                                     entry.get('stored_size', entry['size']))
+            # Record the chunk manifest of a chunked file
+            for seq, (chunk_hash, length) in enumerate(entry.get('chunks') or []):
+                conn.execute("INSERT INTO chunks (version_id, seq, chunk_hash, length) VALUES (?, ?, ?, ?)",
+                             (version_id, seq, chunk_hash, length))
+                add_object_reference(conn, chunk_hash, length)
+        # A deleted file has no latest version any more, so it is backed up again if it comes back
+        for source in deleted:
+            conn.execute("INSERT OR IGNORE INTO deletions (snapshot_id, source) VALUES (?, ?)", (snapshot_id, source))
+            conn.execute("DELETE FROM latest_versions WHERE source = ? AND date_time <= ?", (source, date_time))
+            conn.execute(
+                "UPDATE file_versions SET superseded_at = ? WHERE source = ? "
+                "AND (superseded_at IS NULL OR superseded_at > ?) "
+                "AND (SELECT date_time FROM snapshots WHERE id = snapshot_id) <= ?",
+                (date_time, source, date_time, date_time))
+    return snapshot_id
+
+# Function to count one more reference to an object in the object store
+def add_object_reference(conn, content_hash, size):
+    conn.execute("INSERT OR IGNORE INTO objects (hash, size, refcount) VALUES (?, ?, 0)", (content_hash, size))
+    conn.execute("UPDATE objects SET refcount = refcount + 1 WHERE hash = ?", (content_hash,))
+
+# Function to import backup database text files that are not in the catalog yet
+def import_text_databases(conn, backup_base_dir):
+    known = set(row[0] for row in conn.execute("SELECT date_time FROM snapshots"))
+    imported = 0
+
+    # Database files are saved in the backup base directory, sorted so runs are imported in date order
+    for file in sorted(os.listdir(backup_base_dir)):
+        if not (file.startswith("backup_database_") and file.endswith(".txt")):
+            continue
+        date_time = database_date_time(file)
+        if date_time in known:
+            continue
+
+        database_file = os.path.join(backup_base_dir, file)
+        entries, deleted = read_text_database(database_file)
+        for entry in entries:
+            # Get the size and modification time of the backup file once, at import time
+            try:
+                entry['size'] = os.path.getsize(entry['backup_file'])
+                entry['mtime'] = os.path.getmtime(entry['backup_file'])
+                if entry.get('storage') == 'chunked':
+                    entry['chunks'] = read_manifest(entry['backup_file'])
+                    entry['size'] = sum(length for _, length in entry['chunks'])
+                elif entry.get('storage') == 'packed':
+                    entry['pack_offset'] = int(entry['pack_offset'])
+                    entry['pack_length'] = entry['size'] = int(entry['pack_length'])
+                elif entry.get('compression'):
+                    entry['stored_size'] = entry['size']
+                    entry['size'] = int(entry['raw_size'])
+            except OSError:
+                # Handle cases where the backup file is missing
+                entry['size'] = 0
+                entry['mtime'] = 0
+            # Backup files inside the object store hold a reference to their object
+            if not entry.get('storage') and is_object_file(backup_base_dir, entry):
+                entry['storage'] = 'object'
+
+        add_snapshot(conn, date_time, database_file, entries, deleted)
+        imported += 1
+
+    return imported
+
+# Function to check whether a database entry refers to an object in the object store
+def is_object_file(backup_base_dir, entry):
+    content_hash = entry.get('content_hash')
+    if not content_hash:
+        return False
+    try:
+        return os.path.samefile(entry['backup_file'],
+                                object_path(backup_base_dir, object_key(content_hash, entry.get('compression'))))
+    except OSError:
+        return False
+
+# Function to list the dates and times of all backup runs, oldest first
+def list_snapshot_times(conn):
+    return [row[0] for row in conn.execute("SELECT date_time FROM snapshots ORDER BY date_time")]
+
+# Function to summarise each backup run in date order: (date and time, number of files saved, their size,
+# the size they take in the backup, number of files found deleted). Rows are read one at a time.
+def iter_snapshot_summaries(conn):
+    return conn.execute(
+        "SELECT s.date_time, COUNT(v.id), COALESCE(SUM(v.size), 0), COALESCE(SUM(COALESCE(v.stored_size, v.size)), 0), "
+        "(SELECT COUNT(*) FROM deletions d WHERE d.snapshot_id = s.id) "
+        "FROM snapshots s LEFT JOIN file_versions v ON v.snapshot_id = s.id GROUP BY s.id ORDER BY s.date_time")
+
+# Function to list the history of the source files equal to a path or inside it, in source file and date order:
+# (source, date and time, version id or None for a deletion, size, hash, hash algorithm, storage)
+def iter_path_history(conn, path):
+    path, inside_start, inside_end = path_range(path)
+    return conn.execute(
+        "SELECT v.source, s.date_time, v.id, v.size, v.hash, COALESCE(v.hash_algorithm, ?), v.storage "
+        "FROM file_versions v JOIN snapshots s ON s.id = v.snapshot_id "
+        "WHERE v.source = ? OR (v.source >= ? AND v.source < ?) "
+        "UNION ALL SELECT d.source, s.date_time, NULL, NULL, NULL, NULL, NULL "
+        "FROM deletions d JOIN snapshots s ON s.id = d.snapshot_id "
+        "WHERE d.source = ? OR (d.source >= ? AND d.source < ?) ORDER BY 1, 2",
+        (LEGACY_ALGORITHM, path, inside_start, inside_end, path, inside_start, inside_end))
+
+# Function to list every file version, grouped by snapshot in date order
+def iter_file_versions(conn):
+    return conn.execute(
+        "SELECT v.source, v.backup_file, v.hash, v.size, v.mtime, s.date_time, v.storage, v.id, "
+        "v.pack_offset, v.pack_length, v.compression, v.stored_size, COALESCE(v.hash_algorithm, ?) "
+        "FROM file_versions v JOIN snapshots s ON s.id = v.snapshot_id ORDER BY s.date_time, v.id", (LEGACY_ALGORITHM,))
+
+# Function to get the bounds of the source paths equal to a path or inside it, for an indexed range query
+# Paths inside it start with the path and a separator, and sort before the path followed by the next character.
+def path_range(path, sep=os.sep):
+    path = path.rstrip(sep)
+    return path, path + sep, path + chr(ord(sep) + 1)
+
+# Function to list the source files with a latest version that are equal to a path or inside it
+def latest_sources(conn, path):
+    path, inside_start, inside_end = path_range(path)
+    return [row[0] for row in conn.execute(
+        "SELECT source FROM latest_versions WHERE source = ? OR (source >= ? AND source < ?)",
+        (path, inside_start, inside_end))]
+
+# Function to find the latest backup run at or before a date and time (or the latest of all), or None if there is none
+def snapshot_at(conn, date_time=None):
+    if date_time is None:
+        return conn.execute("SELECT MAX(date_time) FROM snapshots").fetchone()[0]
+    return conn.execute("SELECT MAX(date_time) FROM snapshots WHERE date_time <= ?", (date_time,)).fetchone()[0]
+
+# Function to list the file versions making up the state of the source files as of a backup run: the versions
+# saved at or before the run and not superseded (by a later version or a deletion) until after it.
+# The versions are found through the index on superseded_at, and with path through the index on the source path,
+# so neither the versions superseded before the run nor the other files are read. Rows are as from
+# iter_file_versions, in source file order. (The + in the ORDER BY keeps SQLite from walking the whole source
+# index to avoid sorting; only the versions found are sorted.)
+def iter_snapshot_state(conn, date_time, path=None):
+    if path:
+        path, inside_start, inside_end = path_range(path)
+        where = "(v.source = ? OR (v.source >= ? AND v.source < ?)) AND "
+        params = [path, inside_start, inside_end]
+    else:
+        where = ""
+        params = []
+    return conn.execute(
+        "SELECT v.source, v.backup_file, v.hash, v.size, v.mtime, s.date_time, v.storage, v.id, "
+        "v.pack_offset, v.pack_length, v.compression, v.stored_size, COALESCE(v.hash_algorithm, ?) "
+        f"FROM file_versions v JOIN snapshots s ON s.id = v.snapshot_id WHERE {where}"
+        "(v.superseded_at IS NULL OR v.superseded_at > ?) AND s.date_time <= ? ORDER BY +v.source",
+        [LEGACY_ALGORITHM] + params + [date_time, date_time])
+
+# Function to look up the latest version of a source file
+def latest_version(conn, source):
+    return conn.execute(
+        "SELECT v.source, v.backup_file, v.hash, v.size, v.mtime, l.date_time, v.storage, v.pack_offset, "
+        "v.pack_length, v.compression, v.stored_size, COALESCE(v.hash_algorithm, ?) "
+        "FROM latest_versions l JOIN file_versions v ON v.id = l.version_id WHERE l.source = ?",
+        (LEGACY_ALGORITHM, source)).fetchone()
+
+# Function to get the set of hashes of the latest version of every source file
+# The hashes are binary digests (see backup_hash.binary_digest), which take half the memory of hex strings
+def latest_hashes(conn):
+    return set(binary_digest(row[0]) for row in conn.execute("SELECT hash FROM latest_versions"))
+
+# Function to map each source file whose latest version was hashed with another algorithm than the given one
+# to that algorithm, so the file can be compared with its latest version until it changes
+def latest_hash_algorithms(conn, algorithm):
+    return dict(conn.execute(
+        "SELECT l.source, COALESCE(v.hash_algorithm, ?) AS algorithm FROM latest_versions l "
+        "JOIN file_versions v ON v.id = l.version_id WHERE algorithm != ?", (LEGACY_ALGORITHM, algorithm)))
+
+
+if __name__ == "__main__":
+    # Import the configuration
+    if str(os.name) == 'nt':
+        from backup_config_windows import backup_base_dir
+    else:
+        from backup_config import backup_base_dir
+
+    conn = open_catalog(backup_base_dir)
+    num_imported = import_text_databases(conn, backup_base_dir)
+    conn.close()
+    print(f"Imported {num_imported} backup database files into {os.path.join(backup_base_dir, CATALOG_FILE_NAME)}")
@@ -0,0 +1,127 @@
+import os
+import hashlib
+
+from backup_hash import new_hashers
+from backup_store import object_path, temporary_path
+
+# Suffix of the chunk manifest that stands in for a chunked file
+MANIFEST_SUFFIX = '.chunks'
+
+# Size of the blocks read from a file while looking for chunk boundaries
+READ_SIZE = 8 * 1024 * 1024
+
+# Each byte value maps to a 0 or 1 content bit. The table is derived from MD5 so it never changes
+# between Python versions, because changing it would move every chunk boundary.
+_BIT_TABLE = bytes.maketrans(bytes(range(256)),
+                             bytes(b'01'[hashlib.md5(bytes([b])).digest()[0] & 1] for b in range(256)))
+
+# Function to find the length of the next chunk at the start of a buffer
+# A boundary is placed after a run of content bits that are all 1, so boundaries depend only on the
+# bytes just before them and move with the data when bytes are inserted or removed. The run is found
+# with bytes.find on the translated buffer, so the scan runs at C speed rather than byte by byte.
+# Like FastCDC, a longer run is needed before the average size and a shorter one after it, which keeps
+# chunk sizes close to the average.
+def _next_chunk_length(bits, min_size, avg_size, max_size, final):
+    window_bits = max(avg_size.bit_length() - 1, 4)
+    strict_run = b'1' * (window_bits + 1)
+    loose_run = b'1' * (window_bits - 1)
+
+    found = bits.find(strict_run, min_size - len(strict_run), avg_size)
+    if found >= 0:
+        return found + len(strict_run)
+    if len(bits) < avg_size and not final:
+        return None  # A longer run may still follow in the next block
+    found = bits.find(loose_run, avg_size - len(loose_run), max_size)
+    if found >= 0:
+        return found + len(loose_run)
+    if len(bits) >= max_size:
+        return max_size
+    return len(bits) if final else None
+
+# Function to split a file into content-defined chunks, yielding the data of each chunk
+def iter_chunks(file_path, min_size, avg_size, max_size):
+    data = bytearray()
+    bits = bytearray()
+    with open(file_path, 'rb') as f:
+        final = False
+        while not final:
+            block = f.read(READ_SIZE)
+            final = not block
+            data += block
+            bits += block.translate(_BIT_TABLE)
+
+            while data:
+                length = _next_chunk_length(bits, min_size, avg_size, max_size, final)
+                if length is None:
+                    break  # Need more data to find the boundary
+                yield bytes(data[:length])
+                del data[:length]
+                del bits[:length]
+
+# Function to write one chunk into the object store, unless it is already stored
+# Returns the chunk hash and the number of bytes written
+def store_chunk(backup_base_dir, chunk):
+    chunk_hash = hashlib.md5(chunk).hexdigest()
+    chunk_file = object_path(backup_base_dir, chunk_hash)
+    if os.path.exists(chunk_file):
+        return chunk_hash, 0
+
+    os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+    temp_file = temporary_path(chunk_file)
+    with open(temp_file, 'wb') as f:
+        f.write(chunk)
+    os.replace(temp_file, chunk_file)
+    return chunk_hash, len(chunk)
+
+# Function to get the path of the chunk manifest for a file with the given content hash
+def manifest_path(backup_base_dir, content_hash):
+    return object_path(backup_base_dir, content_hash) + MANIFEST_SUFFIX
+
+# Function to store a file as chunks in the object store, with a manifest listing them in order
+# file_hashes are the hashes (with and without the path) the file was found to have before it is chunked. The
+# chunked data is hashed as it is read, with hash_algorithm, and the manifest is named by the content hash of what
+# was actually chunked, so a file that changes in between is stored under its new content hash.
+# Returns the manifest path, the list of (chunk hash, length), the number of bytes written and the hashes
+# of the stored content
+def store_chunked_file(backup_base_dir, source_file, file_hashes, hash_algorithm, min_size, avg_size, max_size):
+    manifest_file = manifest_path(backup_base_dir, file_hashes[1])
+    if os.path.exists(manifest_file):
+        # The same content has been chunked before
+        return manifest_file, read_manifest(manifest_file), 0, tuple(file_hashes)
+
+    path_hasher, content_hasher = new_hashers(hash_algorithm, source_file)
+    chunks = []
+    bytes_written = 0
+    for chunk in iter_chunks(source_file, min_size, avg_size, max_size):
+        path_hasher.update(chunk)
+        content_hasher.update(chunk)
+        chunk_hash, written = store_chunk(backup_base_dir, chunk)
+        chunks.append((chunk_hash, len(chunk)))
+        bytes_written += written
+    stored_hashes = path_hasher.hexdigest(), content_hasher.hexdigest()
+
+    manifest_file = manifest_path(backup_base_dir, stored_hashes[1])
+    if os.path.exists(manifest_file):
+        return manifest_file, chunks, bytes_written, stored_hashes
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    temp_file = temporary_path(manifest_file)
+    with open(temp_file, 'w') as f:
+        for chunk_hash, length in chunks:
+            f.write(f"{chunk_hash} {length}\n")
+    os.replace(temp_file, manifest_file)
+    return manifest_file, chunks, bytes_written, stored_hashes
+
+# Function to read the list of (chunk hash, length) from a chunk manifest
+def read_manifest(manifest_file):
+    chunks = []
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            chunk_hash, length = line.split()
+            chunks.append((chunk_hash, int(length)))
+    return chunks
+
+# Function to yield the data of a chunked file, in order, from its manifest
+def iter_chunked_data(backup_base_dir, manifest_file):
+    for chunk_hash, _ in read_manifest(manifest_file):
+        with open(object_path(backup_base_dir, chunk_hash), 'rb') as f:
+            yield f.read()
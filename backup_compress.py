@@ -0,0 +1,84 @@
+import os
+import bz2
+import lzma
+import zlib
+import fnmatch
+
+# Compression codecs from the standard library: compressor factory, decompressor factory, and the suffix
+# added to the name of a compressed object in the object store
+CODECS = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj, '.zz'),
+    'lzma': (lambda: lzma.LZMACompressor(preset=6), lzma.LZMADecompressor, '.xz'),
+    'bz2': (lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor, '.bz2'),
+}
+
+# Errors raised when compressed data is damaged
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, EOFError, ValueError)
+
+# File types that are already compressed, so compressing them again only costs time
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif', '.mp3', '.m4a', '.aac', '.ogg', '.opus',
+    '.flac', '.mp4', '.m4v', '.mov', '.mkv', '.avi', '.webm', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst',
+    '.7z', '.rar', '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.pdf',
+}
+
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# A sample from the start of the file is compressed quickly; if it does not shrink to this fraction of its
+# size, the file is stored uncompressed
+PROBE_SIZE = 64 * 1024
+PROBE_RATIO = 0.9
+
+# Function to choose the codec for a file from the compression rules
+# rules is a list of (glob pattern, codec name) and the first match wins. Patterns without a separator are
+# matched against the file name, others against the whole path. A codec of None stores matching files as they are.
+def choose_codec(rules, file_path):
+    name = os.path.normcase(os.path.basename(file_path))
+    path = os.path.normcase(file_path).replace(os.sep, '/')
+    for pattern, codec in rules:
+        pattern = os.path.normcase(pattern)
+        if fnmatch.fnmatchcase(path if '/' in pattern else name, pattern):
+            return codec
+    return None
+
+# Function to check, from its type and a small sample, whether a file is worth compressing
+def is_compressible(file_path, size):
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    with open(file_path, 'rb') as f:
+        sample = f.read(PROBE_SIZE)
+    return len(zlib.compress(sample, 1)) < len(sample) * PROBE_RATIO
+
+# Function to choose how to store a file: the codec to compress it with, or None to store it as it is
+def select_compression(rules, file_path, size):
+    codec = choose_codec(rules, file_path)
+    if codec is None:
+        return None
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec {codec!r} for {file_path}")
+    return codec if is_compressible(file_path, size) else None
+
+# Function to make a compressor for a codec
+def make_compressor(codec):
+    return CODECS[codec][0]()
+
+# Function to decompress a stream of blocks
+def iter_decompressed(blocks, codec):
+    decompressor = CODECS[codec][1]()
+    for block in blocks:
+        data = decompressor.decompress(block)
+        if data:
+            yield data
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+# Function to get the name of the object holding some content in the object store
+# Compressed content is stored under the content hash with the codec's suffix, so a compressed and an
+# uncompressed copy of the same content never get mixed up
+def object_key(content_hash, compression=None):
+    return content_hash + CODECS[compression][2] if compression else content_hash
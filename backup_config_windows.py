@@ -1,7 +1,8 @@
 # List of source directories to be backed up
 source_dirs = ['C:\\Users\\Pete\\OneDrive\\Documents']
 
-# List of directories to be excluded from backup
+# List of directories to be excluded from backup. As well as full paths, entries can be
+# names (e.g. '.cache') or glob patterns (e.g. '*.tmp', '**/node_modules').
 excluded_dirs = []
 
 # Home directory
@@ -10,5 +11,89 @@ home_dir = 'C:\\Users\\Pete'
 # Where to save the backups
 backup_base_dir = 'D:\\Users\\Pete\\File History'
 
+# Set to True to hash every file on every run, ignoring the file cache.
+paranoid_mode = False
+
+# Number of threads hashing source files and copying changed files to the backup.
+# Fewer copy threads suit a slow backup disk; more hash threads suit a fast source disk.
+hash_workers = 4
+copy_workers = 2
+
+# Walk and hash source directories on different devices (disks) at the same time. Each device then gets
+# hash_workers hashing threads of its own (1 or 2 suit a spinning disk), while copy_workers still limits the
+# writes to the backup disk. Off by default, so the source directories are walked one after another;
+# set to True if they are spread over several disks.
+schedule_by_device = False
+
+# Maximum number of files waiting between the walk, hash and copy stages
+pipeline_queue_size = 1000
+
+# Hash algorithm for new backups: 'blake2b', 'sha256' or 'md5'. Files backed up with another algorithm
+# are still checked with the one they were backed up with, and get the new one when they next change.
+hash_algorithm = 'blake2b'
+
+# Hash new and changed files while copying them, so they are read only once.
+fused_copy = True
+
+# Let the operating system copy the data (reflink clones on btrfs/XFS, copy_file_range, sendfile)
+# where it can, instead of copying through Python. The copy is then read back to hash it.
+kernel_copy = True
+
+# Only visit the files changed since the last run, as recorded by the change watcher (backup_watch.py,
+# Linux only), which must be left running. Without a trustworthy journal all source directories are walked.
+use_change_journal = False
+
+# Append files smaller than pack_threshold bytes to large pack files (in a 'packs' directory) instead of
+# storing each one as a file of its own, to save inodes and per-file overhead on the backup disk.
+# A new pack is started when one reaches pack_max_size bytes.
+pack_small_files = False
+pack_threshold = 64 * 1024
+pack_max_size = 256 * 1024 * 1024
+
+# Compress backed up files with a standard library codec ('zlib', 'lzma' or 'bz2'), chosen by the first
+# matching (pattern, codec) rule; a codec of None stores matching files as they are. Patterns without a
+# '/' are matched against file names. Already compressed types (JPEG, PNG, MP4, zip...) and files whose
+# first 64 KB do not shrink are stored as they are. Compression runs on the copy_workers threads.
+compress_files = False
+compression_rules = [
+    ('*.log', 'lzma'),
+    ('*.txt', 'lzma'),
+    ('*', 'zlib'),
+]
+
+# Store file content once in an 'objects' directory, keyed by a hash of the content alone,
+# so renamed, moved and duplicate files take no extra space or copy time.
+# Off by default: set to True to use it. Runs made before switching it on are left as they are,
+# and files are moved into the store as they change.
+use_object_store = False
+
+# How each run's timestamped directory tree is made from the object store:
+# 'hardlink' to link each backed up file into it, or 'none' to record the object paths only.
+snapshot_links = 'hardlink'
+
+# Store files at least chunk_threshold bytes long as content-defined chunks, so a small change
+# to a large file (a VM image, a video project) only stores the chunks that changed.
+chunk_large_files = False
+chunk_threshold = 64 * 1024 * 1024
+
+# Minimum, average and maximum chunk sizes in bytes
+chunk_min_size = 256 * 1024
+chunk_avg_size = 1024 * 1024
+chunk_max_size = 4 * 1024 * 1024
+
 # Diresctory to restore files into.
-restore_dir = 'C:\\Users\\Pete\\Restore'
\ No newline at end of file
+restore_dir = 'C:\\Users\\Pete\\Restore'
+
+# Number of threads copying files when restoring directly (without a restore script)
+restore_workers = 4
+
+# Checking the hashes of backup files (restore.py --script and backup_verify.py):
+# the number of hashing threads, the maximum total read rate in bytes per second (0 for no limit),
+# and whether to check only the latest version of each file.
+verify_workers = 4
+verify_bandwidth_limit = 0
+verify_latest_only = False
+
+# Backup runs kept by backup_prune.py: the last few runs, plus the latest run of each of the
+# most recent days, weeks, months and years that have a run ('hourly' can also be used).
+retention_policy = {'last': 10, 'daily': 7, 'weekly': 52, 'monthly': 24, 'yearly': 10}
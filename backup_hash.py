@@ -0,0 +1,91 @@
+import hashlib
+import threading
+
+# Hash algorithms that can be used for new backups, by the name recorded in the backup database
+# BLAKE2b is cut to 32 bytes, as strong as SHA-256 and at least as fast as MD5. SHA-256 is the fastest of all on
+# CPUs with SHA extensions (most x86 processors since 2019 and 64-bit ARM).
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+
+# Algorithm of the entries saved before the algorithm was recorded
+LEGACY_ALGORITHM = 'md5'
+
+# Size of the reusable read buffer. Large reads keep the per-call overhead low on fast disks, and hashlib
+# releases the GIL while it hashes each block, so several threads can hash at once.
+# Files are not memory mapped: a source file truncated while it is being read would crash the process.
+BLOCK_SIZE = 1024 * 1024
+
+_thread_buffers = threading.local()
+
+# Function to get this thread's reusable read buffer
+def _get_buffer():
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_buffers.buffer = bytearray(BLOCK_SIZE)
+    return buffer
+
+# Function to make a new hasher for an algorithm, or raise ValueError if the algorithm is unknown
+def new_hasher(algorithm):
+    try:
+        return HASH_ALGORITHMS[algorithm or LEGACY_ALGORITHM]()
+    except KeyError:
+        raise ValueError(f"Unknown hash algorithm {algorithm!r}, use one of {', '.join(HASH_ALGORITHMS)}") from None
+
+# Function to make the pair of hashers for a file: the first with hash_path prefixed, the second of the content alone
+def new_hashers(algorithm, hash_path=None):
+    path_hasher = new_hasher(algorithm)
+    if hash_path is not None:
+        path_hasher.update(hash_path.encode('utf-8'))
+    return path_hasher, new_hasher(algorithm)
+
+# Function to hash an open file from its current position, returning the hashes with and without the path prefix
+def hash_open_file(f, algorithm, hash_path=None):
+    path_hasher, content_hasher = new_hashers(algorithm, hash_path)
+    buffer = _get_buffer()
+    view = memoryview(buffer)
+    while True:
+        count = f.readinto(buffer)
+        if not count:
+            break
+        path_hasher.update(view[:count])
+        content_hasher.update(view[:count])
+    return path_hasher.hexdigest(), content_hasher.hexdigest()
+
+# Function to hash a file, returning the hashes with and without the path prefix
+def hash_file(file_path, algorithm, hash_path=None):
+    with open(file_path, 'rb', buffering=0) as f:
+        return hash_open_file(f, algorithm, hash_path)
+
+# Function to hash data already in memory, returning the hashes with and without the path prefix
+def hash_bytes(data, algorithm, hash_path=None):
+    path_hasher, content_hasher = new_hashers(algorithm, hash_path)
+    path_hasher.update(data)
+    content_hasher.update(data)
+    return path_hasher.hexdigest(), content_hasher.hexdigest()
+
+# Function to hash a stream of blocks with hash_path prefixed
+# throttle, if given, is called with the size of each block (to cap the read rate)
+def hash_blocks(blocks, algorithm, hash_path=None, throttle=None):
+    hasher = new_hasher(algorithm)
+    if hash_path is not None:
+        hasher.update(hash_path.encode('utf-8'))
+    for data in blocks:
+        if throttle:
+            throttle(len(data))
+        hasher.update(data)
+    return hasher.hexdigest()
+
+# Function to turn a hex digest into the binary digest kept in memory, half the size
+# Anything that is not a hex digest (such as the empty hash of a damaged entry) is kept as it is
+def binary_digest(hex_digest):
+    try:
+        return bytes.fromhex(hex_digest)
+    except (ValueError, TypeError):
+        return hex_digest
+
+# Function to turn a digest from binary_digest back into hex
+def hex_digest(digest):
+    return digest.hex() if isinstance(digest, bytes) else digest
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import threading
+
+from backup_store import OBJECTS_DIR_NAME
+
+# Prefix of the journal files of backup runs in progress, saved in the backup base directory
+# A journal left behind by a run that was killed or failed records the files that run had already backed up
+JOURNAL_PREFIX = 'backup_journal_'
+JOURNAL_SUFFIX = '.txt'
+
+# The journal is synced to disk after this many entries or this many seconds, whichever comes first,
+# so at most one batch of copied files is lost if the run is interrupted
+JOURNAL_BATCH_SIZE = 64
+JOURNAL_BATCH_SECONDS = 2.0
+
+# Function to get the path of the journal of a backup run
+def journal_path(backup_base_dir, date_time):
+    return os.path.join(backup_base_dir, f"{JOURNAL_PREFIX}{date_time}{JOURNAL_SUFFIX}")
+
+# Function to list the journals left behind by interrupted backup runs, oldest first
+# Returns a list of (date and time of the run, journal file path)
+def find_interrupted_runs(backup_base_dir):
+    runs = []
+    for file_name in os.listdir(backup_base_dir):
+        if file_name.startswith(JOURNAL_PREFIX) and file_name.endswith(JOURNAL_SUFFIX):
+            date_time = file_name[len(JOURNAL_PREFIX):-len(JOURNAL_SUFFIX)]
+            runs.append((date_time, os.path.join(backup_base_dir, file_name)))
+    return sorted(runs)
+
+# Class to append the entries of a backup run to its journal as each copy completes
+# Entries are written as JSON lines, and the journal is synced to disk in batches
+class RunJournal:
+    def __init__(self, backup_base_dir, date_time):
+        self.path = journal_path(backup_base_dir, date_time)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    # Function to add an entry, syncing the batch to disk when it is full or old enough
+    def append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.unsynced += 1
+            if self.unsynced >= JOURNAL_BATCH_SIZE or time.monotonic() - self.last_sync >= JOURNAL_BATCH_SECONDS:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    # Function to sync the last batch and close the journal
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._sync()
+                self.file.close()
+
+# Function to read the entries of a journal whose backup files are complete
+# A line cut short by the interruption, and entries whose backup file is missing or has the wrong size
+# (its data was not on disk yet), are left out so those files are backed up again
+def read_journal(journal_file):
+    entries = {}
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                stat_result = os.stat(entry['backup_file'])
+            except (ValueError, KeyError, OSError):
+                continue
+            if entry.get('storage') == 'packed':
+                if stat_result.st_size < entry['pack_offset'] + entry['pack_length']:
+                    continue
+            elif entry.get('storage') != 'chunked' and stat_result.st_size != entry.get('stored_size', entry['size']):
+                continue
+            entries[entry['source']] = entry  # A later entry for the same file replaces an earlier one
+    return list(entries.values())
+
+# Function to remove temporary files left by an interrupted run, in its directory tree and the object store
+def remove_temporary_files(backup_base_dir, date_time):
+    snapshot_dir = os.path.join(backup_base_dir, date_time)
+    for root, dirs, files in os.walk(snapshot_dir):
+        for file_name in files:
+            if '.tmp-' in file_name:
+                os.remove(os.path.join(root, file_name))
+    temp_dir = os.path.join(backup_base_dir, OBJECTS_DIR_NAME, 'tmp')
+    if os.path.isdir(temp_dir):
+        for file_name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, file_name))
@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import heapq
+import threading
+import contextlib
+
+# Name of the metrics log, saved in the backup base directory: one JSON summary per line, one line per run
+METRICS_FILE_NAME = 'backup_metrics.jsonl'
+
+# Minimum number of seconds between two progress lines
+PROGRESS_INTERVAL = 5
+
+# Number of slowest files listed in the summary of a run
+SLOWEST_FILES = 10
+
+# Class to collect the timings of a run: per phase, the files and bytes processed, the time spent by all
+# threads together (busy time) and the time from its first to its last file (wall time), plus the slowest files
+# It is shared by the threads of a run, so every update takes a lock.
+class RunMetrics:
+    def __init__(self, slowest_files=SLOWEST_FILES, progress_interval=PROGRESS_INTERVAL):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}  # Phase name -> dictionary of counters
+        self.slowest = []  # Heap of (seconds, file path, phase), the fastest of the slowest on top
+        self.slowest_files = slowest_files
+        self.progress_interval = progress_interval
+        self.last_progress = self.start
+
+    # Function to record the time spent on one file (or one step) in a phase
+    def add(self, phase, seconds, file_path=None, num_bytes=0, num_files=1, start=None):
+        now = time.perf_counter()
+        start = now - seconds if start is None else start
+        with self.lock:
+            counters = self.phases.get(phase)
+            if counters is None:
+                counters = self.phases[phase] = {'files': 0, 'bytes': 0, 'busy_seconds': 0.0,
+                                                 'first_start': start, 'last_end': now}
+            counters['files'] += num_files
+            counters['bytes'] += num_bytes
+            counters['busy_seconds'] += seconds
+            counters['first_start'] = min(counters['first_start'], start)
+            counters['last_end'] = max(counters['last_end'], now)
+            if file_path is not None and self.slowest_files:
+                item = (seconds, file_path, phase)
+                if len(self.slowest) < self.slowest_files:
+                    heapq.heappush(self.slowest, item)
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    # Function to time a step of a phase run by one thread, e.g. loading the catalog
+    @contextlib.contextmanager
+    def phase(self, phase, num_files=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, num_files=num_files, start=start)
+
+    # Function to time each item of an iterator, such as the directory walk, as it is produced
+    def timed_iter(self, phase, iterator, size_of=None):
+        iterator = iter(iterator)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(phase, time.perf_counter() - start, num_bytes=size_of(item) if size_of else 0, start=start)
+            yield item
+
+    # Function to print a progress line, at most once per progress interval unless forced
+    def progress(self, force=False):
+        now = time.perf_counter()
+        with self.lock:
+            if not force and now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+            phases = dict((phase, dict(counters)) for phase, counters in self.phases.items())
+        elapsed = now - self.start
+        parts = []
+        for phase, counters in phases.items():
+            part = f"{phase} {counters['files']} files"
+            if counters['bytes']:
+                part += f" ({counters['bytes'] / 1e6:.1f} MB, {counters['bytes'] / max(elapsed, 1e-9) / 1e6:.1f} MB/s)"
+            parts.append(part)
+        print(f"[{int(elapsed) // 60:02d}:{int(elapsed) % 60:02d}] " + ", ".join(parts), flush=True)
+
+    # Function to summarise the run as a dictionary that can be saved as JSON
+    def summary(self, **details):
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            phases = {}
+            for phase, counters in self.phases.items():
+                wall_seconds = max(counters['last_end'] - counters['first_start'], 1e-9)
+                phases[phase] = {
+                    'files': counters['files'],
+                    'bytes': counters['bytes'],
+                    'wall_seconds': round(wall_seconds, 3),
+                    'busy_seconds': round(counters['busy_seconds'], 3),
+                    'files_per_second': round(counters['files'] / wall_seconds, 1),
+                    'mb_per_second': round(counters['bytes'] / wall_seconds / 1e6, 2),
+                }
+            slowest = [{'file': file_path, 'phase': phase, 'seconds': round(seconds, 3)}
+                       for seconds, file_path, phase in sorted(self.slowest, reverse=True)]
+        summary = dict(details)
+        summary.update({'elapsed_seconds': round(elapsed, 3), 'phases': phases, 'slowest_files': slowest})
+        return summary
+
+# Function to append the summary of a run to the metrics log
+def append_metrics_log(backup_base_dir, summary):
+    with open(os.path.join(backup_base_dir, METRICS_FILE_NAME), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(summary) + '\n')
+
+# Function to profile the code run inside it with cProfile and/or tracemalloc
+# With profile, every thread started inside is profiled too; the combined statistics are saved to
+# output_prefix + '.prof' and the top functions printed. With trace_memory, the peak memory use and the
+# lines that allocated the most memory are printed.
+@contextlib.contextmanager
+def profiled(output_prefix, profile=False, trace_memory=False, top=25):
+    if not (profile or trace_memory):
+        yield
+        return
+
+    profiles = []
+    profiles_lock = threading.Lock()
+    if profile:
+        import cProfile
+
+        # Each new thread replaces this hook with a profiler of its own on its first call
+        def start_thread_profile(frame, event, arg):
+            sys.setprofile(None)
+            thread_profile = cProfile.Profile()
+            try:
+                thread_profile.enable()
+            except ValueError:
+                return  # Python 3.12 and later: the main profiler already sees every thread
+            with profiles_lock:
+                profiles.append(thread_profile)
+
+        main_profile = cProfile.Profile()
+        threading.setprofile(start_thread_profile)
+        main_profile.enable()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    try:
+        yield
+    finally:
+        # Stop both before reporting, so neither measures the other's reporting
+        if profile:
+            main_profile.disable()
+            threading.setprofile(None)
+            with profiles_lock:
+                for thread_profile in profiles:
+                    thread_profile.disable()
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        if profile:
+            import pstats
+            stats = pstats.Stats(main_profile)
+            for thread_profile in profiles:
+                stats.add(thread_profile)
+            profile_file = output_prefix + '.prof'
+            stats.dump_stats(profile_file)
+            print(f"\nProfile saved to: {profile_file}")
+            stats.sort_stats('cumulative').print_stats(top)
+        if trace_memory:
+            print(f"\nMemory: {current / 1e6:.1f} MB allocated at the end, {peak / 1e6:.1f} MB at the peak")
+            for statistic in snapshot.statistics('lineno')[:10]:
+                print(statistic)
@@ -0,0 +1,68 @@
+import os
+import threading
+
+# Name of the directory holding the pack files, inside the backup base directory
+PACKS_DIR_NAME = 'packs'
+
+# Class to append small files to pack files, shared by the copying threads of one backup run
+# Each pack is named after the run and numbered, and a new pack is started when one reaches max_size.
+# The offset and length of each member are saved in the backup database, so members can be read back
+# by seeking, without unpacking anything.
+class PackWriter:
+    def __init__(self, backup_base_dir, date_time, max_size):
+        self.packs_dir = os.path.join(backup_base_dir, PACKS_DIR_NAME)
+        self.date_time = date_time
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.offset = 0
+        self.number = 0
+
+    # Function to start a new pack, skipping numbers used by an earlier attempt at the same run
+    def _start_pack(self):
+        self._close_pack()
+        os.makedirs(self.packs_dir, exist_ok=True)
+        while True:
+            self.number += 1
+            self.path = os.path.join(self.packs_dir, f"{self.date_time}-{self.number:04d}.pack")
+            if not os.path.exists(self.path):
+                break
+        self.file = open(self.path, 'wb')
+        self.offset = 0
+
+    def _close_pack(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    # Function to append the content of a small file, returning the pack path and the member's offset
+    def add(self, data):
+        with self.lock:
+            if self.file is None or (self.offset > 0 and self.offset + len(data) > self.max_size):
+                self._start_pack()
+            offset = self.offset
+            self.file.write(data)
+            # Hand the data to the operating system, so a member recorded in the journal survives the run being killed
+            self.file.flush()
+            self.offset += len(data)
+            return self.path, offset
+
+    # Function to sync and close the pack being written
+    def close(self):
+        with self.lock:
+            self._close_pack()
+
+# Function to read a member of a pack file in blocks, seeking straight to it
+def iter_pack_member(pack_file, offset, length, block_size=1024 * 1024):
+    with open(pack_file, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                raise OSError(f"{pack_file} ends before its member at offset {offset} ({length} bytes)")
+            remaining -= len(data)
+            yield data
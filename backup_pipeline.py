@@ -0,0 +1,91 @@
+import queue
+import logging
+import threading
+
+# Marker put on a queue to tell the workers reading from it to finish
+_END_OF_QUEUE = None
+
+# Function to run one worker: take items from in_queue, process them and pass any result on
+def _worker(process, in_queue, output, errors):
+    while True:
+        item = in_queue.get()
+        if item is _END_OF_QUEUE:
+            break
+        try:
+            result = process(item)
+        except Exception as e:
+            # Record the failure and carry on with the other files
+            error_msg = f"Error: {item}: {e}"
+            print(error_msg)
+            logging.error(error_msg)
+            errors.append((item, e))
+            continue
+        if result is not None:
+            output(result)
+
+# Function to start a pool of worker threads on a queue
+def _start_workers(count, process, in_queue, output, errors):
+    workers = []
+    for _ in range(max(1, count)):
+        worker = threading.Thread(target=_worker, args=(process, in_queue, output, errors), daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+# Function to tell a pool of workers to finish and wait for them
+def _stop_workers(workers, in_queue):
+    for _ in workers:
+        in_queue.put(_END_OF_QUEUE)
+    for worker in workers:
+        worker.join()
+
+# Function to run the walk -> hash -> copy pipeline
+# walk_files is an iterable of files, hash_file returns a copy job (or None to skip the file)
+# and copy_file returns the result to be saved (or None). Results are returned in completion order.
+def run_pipeline(walk_files, hash_file, copy_file, hash_workers, copy_workers, queue_size):
+    return run_device_pipeline({None: walk_files}, hash_file, copy_file, hash_workers, copy_workers, queue_size)
+
+# Function to run the pipeline with a walk and a pool of hashing threads of its own for each source device
+# walks maps each device to an iterable of its files. The devices are walked and hashed at the same time, each
+# by hash_workers threads at most, so the run takes about as long as its slowest device rather than the sum of
+# all of them. All the devices feed the one pool of copy_workers threads, which limits the writes to the backup.
+def run_device_pipeline(walks, hash_file, copy_file, hash_workers, copy_workers, queue_size):
+    copy_queue = queue.Queue(maxsize=queue_size)
+    results = []  # list.append is thread safe
+    errors = []
+    walk_errors = []
+    stopping = threading.Event()
+
+    copiers = _start_workers(copy_workers, copy_file, copy_queue, results.append, errors)
+    devices = []
+    for walk_files in walks.values():
+        hash_queue = queue.Queue(maxsize=queue_size)
+        devices.append((walk_files, hash_queue,
+                        _start_workers(hash_workers, hash_file, hash_queue, copy_queue.put, errors)))
+
+    # Each walker stage runs in a thread of its own and blocks when its hash queue is full
+    def walk(walk_files, hash_queue):
+        try:
+            for item in walk_files:
+                if stopping.is_set():
+                    break
+                hash_queue.put(item)
+        except BaseException as e:
+            walk_errors.append(e)
+
+    walkers = [threading.Thread(target=walk, args=(walk_files, hash_queue), daemon=True)
+               for walk_files, hash_queue, _ in devices]
+    try:
+        for walker in walkers:
+            walker.start()
+        for walker in walkers:
+            walker.join()
+    finally:
+        stopping.set()
+        for _, hash_queue, hashers in devices:
+            _stop_workers(hashers, hash_queue)
+        _stop_workers(copiers, copy_queue)
+
+    if walk_errors:
+        raise walk_errors[0]
+    return results, errors
@@ -0,0 +1,273 @@
+import os
+import bisect
+import logging
+import datetime
+
+from backup_catalog import open_catalog, import_text_databases, write_database_entry, is_object_file, \
+    iter_source_events
+from backup_store import object_path
+from backup_chunks import manifest_path
+from backup_compress import object_key
+
+# Format of the date and time of a backup run, as used in directory and database file names
+DATE_TIME_FORMAT = "%Y-%m-%d_%Hh%Mm%Ss"
+
+# Functions giving the period a backup run belongs to, for each kind of retention rule
+RETENTION_PERIODS = {
+    'hourly': lambda t: (t.year, t.month, t.day, t.hour),
+    'daily': lambda t: (t.year, t.month, t.day),
+    'weekly': lambda t: tuple(t.isocalendar()[:2]),
+    'monthly': lambda t: (t.year, t.month),
+    'yearly': lambda t: (t.year,),
+}
+
+# Function to choose the backup runs to keep under a retention policy
+# policy is a dictionary such as {'last': 10, 'daily': 7, 'weekly': 52}: keep the last 10 runs, plus the
+# latest run of each of the last 7 days and of each of the last 52 weeks that have a run
+def select_snapshots_to_keep(date_times, policy):
+    parsed = []
+    for date_time in date_times:
+        try:
+            parsed.append((datetime.datetime.strptime(date_time, DATE_TIME_FORMAT), date_time))
+        except ValueError:
+            parsed.append((None, date_time))  # Keep runs whose date cannot be read
+    newest_first = sorted((p for p in parsed if p[0] is not None), reverse=True)
+
+    keep = set(date_time for when, date_time in parsed if when is None)
+    keep.update(date_time for _, date_time in newest_first[:max(1, policy.get('last', 0))])
+    for rule, period_of in RETENTION_PERIODS.items():
+        count = policy.get(rule, 0)
+        periods = set()
+        for when, date_time in newest_first:
+            if len(periods) >= count:
+                break
+            period = period_of(when)
+            if period not in periods:
+                periods.add(period)
+                keep.add(date_time)  # The latest run of this period
+    return keep
+
+# Function to work out which file versions and deletions are still needed
+# A version is needed if it is the current version of its file at any kept run, that is, if a kept run
+# falls between this version and the next version or deletion of the same file. The same goes for a deletion,
+# which keeps a restore to a kept run from bringing back a file deleted before it, unless no version of the file
+# is kept before it. Needed versions and deletions recorded by runs that are removed are moved to the first kept
+# run after them, so a file deleted before the kept runs no longer has any versions.
+# Returns (moves, unneeded, deletion_moves, unneeded_deletions, superseded): dictionaries of version id (or
+# deletion rowid) -> kept snapshot id, lists of the ids that can be deleted, and a dictionary of version id ->
+# new superseded_at for the kept versions whose next version or deletion changes.
+def plan_prune(conn, keep):
+    snapshot_ids = dict(conn.execute("SELECT date_time, id FROM snapshots"))
+    kept_times = sorted(keep)
+    moves = {}
+    unneeded = []
+    deletion_moves = {}
+    unneeded_deletions = []
+    superseded = {}
+
+    def plan_events(events):
+        kept = []  # (is deletion, id, kept run it ends up in, superseded_at) of the events kept
+        for i, (is_deletion, event_id, date_time, snapshot_id, superseded_at) in enumerate(events):
+            next_time = events[i + 1][2] if i + 1 < len(events) else None
+            k = bisect.bisect_left(kept_times, date_time)
+            # A deletion is only needed if the last event kept is a version
+            if (k < len(kept_times) and (next_time is None or kept_times[k] < next_time)
+                    and (not is_deletion or (kept and not kept[-1][0]))):
+                kept.append((is_deletion, event_id, kept_times[k], superseded_at))
+                target = snapshot_ids[kept_times[k]]
+                if target != snapshot_id:
+                    (deletion_moves if is_deletion else moves)[event_id] = target
+            else:
+                (unneeded_deletions if is_deletion else unneeded).append(event_id)
+
+        # Each kept version is superseded at the run the next kept event ends up in
+        for i, (is_deletion, event_id, kept_time, superseded_at) in enumerate(kept):
+            next_kept_time = kept[i + 1][2] if i + 1 < len(kept) else None
+            if not is_deletion and superseded_at != next_kept_time:
+                superseded[event_id] = next_kept_time
+
+    # Stream the versions and deletions in source file order, one file at a time
+    current_source = None
+    events = []
+    for source, date_time, is_deletion, event_id, snapshot_id, superseded_at in iter_source_events(conn):
+        if source != current_source:
+            plan_events(events)
+            current_source = source
+            events = []
+        events.append((is_deletion, event_id, date_time, snapshot_id, superseded_at))
+    plan_events(events)
+
+    return moves, unneeded, deletion_moves, unneeded_deletions, superseded
+
+# Function to check that a path is inside the backup base directory before deleting it
+def _is_inside(backup_base_dir, path):
+    base = os.path.realpath(backup_base_dir)
+    return os.path.commonpath([base, os.path.realpath(path)]) == base
+
+# Function to delete a backup file, returning the number of bytes freed
+# A file that still has other hardlinks frees nothing until its last link is deleted.
+def _delete_file(backup_base_dir, path):
+    if not _is_inside(backup_base_dir, path):
+        logging.error(f"Error: Not deleting {path}, it is outside {backup_base_dir}")
+        return 0
+    try:
+        stat_result = os.stat(path)
+        os.remove(path)
+    except OSError:
+        return 0
+    return stat_result.st_size if stat_result.st_nlink <= 1 else 0
+
+# Function to rewrite the backup database text file of a run from the catalog, deletions included
+def rewrite_text_database(conn, snapshot_id, database_file):
+    temp_file = database_file + '.tmp'
+    with open(temp_file, 'w') as db:
+        for source, backup_file, file_hash, content_hash, storage, pack_offset, pack_length, compression, \
+                size, hash_algorithm in conn.execute(
+                "SELECT source, backup_file, hash, content_hash, storage, pack_offset, pack_length, compression, size, "
+                "hash_algorithm FROM file_versions WHERE snapshot_id = ? ORDER BY source", (snapshot_id,)):
+            write_database_entry(db, {'source': source, 'backup_file': backup_file, 'hash': file_hash,
+                                      'hash_algorithm': hash_algorithm,
+                                      'content_hash': content_hash, 'storage': storage,
+                                      'pack_offset': pack_offset, 'pack_length': pack_length,
+                                      'compression': compression, 'raw_size': size if compression else None})
+        for (source,) in conn.execute("SELECT source FROM deletions WHERE snapshot_id = ? ORDER BY source",
+                                      (snapshot_id,)):
+            write_database_entry(db, {'deleted': source})
+    os.replace(temp_file, database_file)
+
+# Function to remove empty directories left in a removed run's directory tree
+def _remove_empty_dirs(top_dir):
+    for root, dirs, files in os.walk(top_dir, topdown=False):
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass  # Not empty: it holds files of versions that are still needed
+
+# Function to prune the backup history under a retention policy
+# Returns a summary dictionary. With dry_run, nothing is changed.
+def prune_backups(backup_base_dir, policy, dry_run=False):
+    conn = open_catalog(backup_base_dir)
+    import_text_databases(conn, backup_base_dir)
+
+    snapshots = conn.execute("SELECT id, date_time, database_file FROM snapshots ORDER BY date_time").fetchall()
+    keep = select_snapshots_to_keep([date_time for _, date_time, _ in snapshots], policy)
+    removed = [s for s in snapshots if s[1] not in keep]
+    moves, unneeded, deletion_moves, unneeded_deletions, superseded = plan_prune(conn, keep)
+
+    summary = {'snapshots_kept': len(snapshots) - len(removed), 'snapshots_removed': len(removed),
+               'versions_merged': len(moves), 'versions_deleted': len(unneeded),
+               'deletions_merged': len(deletion_moves), 'deletions_dropped': len(unneeded_deletions),
+               'bytes_reclaimed': 0}
+    if dry_run or not removed:
+        conn.close()
+        return summary
+
+    # Collect what the unneeded versions hold before their rows are deleted
+    deleted_versions = []
+    for i in range(0, len(unneeded), 500):
+        batch = unneeded[i:i + 500]
+        marks = ','.join('?' * len(batch))
+        deleted_versions += conn.execute(
+            f"SELECT id, source, backup_file, content_hash, storage, compression FROM file_versions "
+            f"WHERE id IN ({marks})",
+            batch).fetchall()
+
+    with conn:
+        # Merge the needed versions of removed runs into the kept runs that follow them
+        conn.executemany("UPDATE file_versions SET snapshot_id = ? WHERE id = ?",
+                         [(target, version_id) for version_id, target in moves.items()])
+        conn.executemany("UPDATE deletions SET snapshot_id = ? WHERE rowid = ?",
+                         [(target, rowid) for rowid, target in deletion_moves.items()])
+        conn.executemany("DELETE FROM deletions WHERE rowid = ?", [(rowid,) for rowid in unneeded_deletions])
+        conn.executemany("UPDATE file_versions SET superseded_at = ? WHERE id = ?",
+                         [(superseded_at, version_id) for version_id, superseded_at in superseded.items()])
+
+        # Delete the unneeded versions, dropping their references to stored objects and chunks
+        released_objects = []
+        for version_id, source, backup_file, content_hash, storage, compression in deleted_versions:
+            if storage == 'object' or (storage is None and
+                                       is_object_file(backup_base_dir, {'backup_file': backup_file,
+                                                                        'content_hash': content_hash,
+                                                                        'compression': compression})):
+                released_objects.append(object_key(content_hash, compression))
+            for (chunk_hash,) in conn.execute("SELECT chunk_hash FROM chunks WHERE version_id = ?", (version_id,)):
+                released_objects.append(chunk_hash)
+            conn.execute("DELETE FROM chunks WHERE version_id = ?", (version_id,))
+            conn.execute("DELETE FROM verifications WHERE version_id = ?", (version_id,))
+            conn.execute("DELETE FROM file_versions WHERE id = ?", (version_id,))
+        for content_hash in released_objects:
+            conn.execute("UPDATE objects SET refcount = refcount - 1 WHERE hash = ?", (content_hash,))
+        unused_objects = [row[0] for row in conn.execute("SELECT hash FROM objects WHERE refcount <= 0")]
+        conn.execute("DELETE FROM objects WHERE refcount <= 0")
+
+        conn.executemany("DELETE FROM snapshots WHERE id = ?", [(s[0],) for s in removed])
+
+    # Rewrite the database files of the kept runs that received merged versions,
+    # and delete the database files of the removed runs
+    database_files = dict((s[0], s[2]) for s in snapshots)
+    for snapshot_id in set(moves.values()) | set(deletion_moves.values()):
+        if database_files.get(snapshot_id):
+            rewrite_text_database(conn, snapshot_id, database_files[snapshot_id])
+    for _, _, database_file in removed:
+        if database_file and os.path.exists(database_file):
+            os.remove(database_file)
+
+    # Delete the backup files nothing refers to any more
+    bytes_reclaimed = 0
+    for version_id, source, backup_file, content_hash, storage, compression in deleted_versions:
+        still_used = conn.execute("SELECT 1 FROM file_versions WHERE backup_file = ? LIMIT 1",
+                                  (backup_file,)).fetchone()
+        # Objects themselves are only deleted once their reference count drops to zero
+        is_object = content_hash and os.path.normcase(backup_file) == os.path.normcase(
+            object_path(backup_base_dir, object_key(content_hash, compression)))
+        if not still_used and not is_object:
+            bytes_reclaimed += _delete_file(backup_base_dir, backup_file)
+        if storage == 'chunked' and content_hash:
+            manifest_used = conn.execute(
+                "SELECT 1 FROM file_versions WHERE content_hash = ? AND storage = 'chunked' LIMIT 1",
+                (content_hash,)).fetchone()
+            if not manifest_used:
+                bytes_reclaimed += _delete_file(backup_base_dir, manifest_path(backup_base_dir, content_hash))
+    for content_hash in unused_objects:
+        bytes_reclaimed += _delete_file(backup_base_dir, object_path(backup_base_dir, content_hash))
+
+    for _, date_time, _ in removed:
+        snapshot_dir = os.path.join(backup_base_dir, date_time)
+        if os.path.isdir(snapshot_dir):
+            _remove_empty_dirs(snapshot_dir)
+
+    # Compact the catalog now that rows have been deleted
+    conn.execute("VACUUM")
+    conn.close()
+
+    summary['bytes_reclaimed'] = bytes_reclaimed
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # Import the configuration
+    if str(os.name) == 'nt':
+        from backup_config_windows import backup_base_dir, retention_policy
+    else:
+        from backup_config import backup_base_dir, retention_policy
+
+    parser = argparse.ArgumentParser(description="Remove old backup runs under the retention policy.")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be removed")
+    args = parser.parse_args()
+
+    # Configure the logging
+    log_file = os.path.join(backup_base_dir, 'backup_log.txt')
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    summary = prune_backups(backup_base_dir, retention_policy, args.dry_run)
+    prefix = "Would remove" if args.dry_run else "Removed"
+    print(f"{prefix} {summary['snapshots_removed']} backup runs, keeping {summary['snapshots_kept']}.")
+    print(f"{prefix} {summary['versions_deleted']} file versions; "
+          f"{summary['versions_merged']} still needed were merged into kept runs.")
+    if not args.dry_run:
+        print(f"Space reclaimed: {summary['bytes_reclaimed'] / 1e6:.1f} MB")
+        logging.info(f"Prune: removed {summary['snapshots_removed']} backup runs and "
+                     f"{summary['versions_deleted']} file versions, reclaimed {summary['bytes_reclaimed']} bytes")
@@ -0,0 +1,129 @@
+import os
+import sys
+import argparse
+
+from backup_catalog import open_catalog, import_text_databases, list_snapshot_times, snapshot_at, \
+    iter_snapshot_state, iter_snapshot_summaries, iter_path_history, parse_point_in_time
+
+# Function to compare the state of the source files at two backup runs, one file at a time
+# Both states are read from the catalog in source file order and merged, so the history is never all in memory.
+# Yields (change, source file, old row, new row), where change is 'added', 'modified' or 'removed' and the rows
+# are as from iter_file_versions (None for a file missing from that run).
+def diff_snapshots(conn, from_time, to_time, path=None):
+    old_rows = iter_snapshot_state(conn, from_time, path)
+    new_rows = iter_snapshot_state(conn, to_time, path)
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield 'removed', old[0], old, None
+            old = next(old_rows, None)
+        elif old is None or new[0] < old[0]:
+            yield 'added', new[0], None, new
+            new = next(new_rows, None)
+        else:
+            # A file saved again with the same content (e.g. by a resumed run) has not changed
+            if old[7] != new[7] and (old[2] != new[2] or old[3] != new[3]):
+                yield 'modified', new[0], old, new
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+
+# Function to find the backup run at or before a date and time, exiting with a message if there is none
+def _resolve_snapshot(conn, when):
+    date_time = snapshot_at(conn, when)
+    if date_time is None:
+        print(f"No backup run at or before {when}.")
+        sys.exit(1)
+    return date_time
+
+# Function to print each backup run with the number and size of the files it saved and the files it found deleted
+def print_snapshots(conn):
+    print(f"{'Backup run':<22}{'Files':>10}{'Size (MB)':>14}{'Stored (MB)':>14}{'Deleted':>10}")
+    for date_time, num_files, size, stored_size, num_deleted in iter_snapshot_summaries(conn):
+        print(f"{date_time:<22}{num_files:>10}{size / 1e6:>14.1f}{stored_size / 1e6:>14.1f}{num_deleted:>10}")
+
+# Function to print the files added, modified and removed between two backup runs, followed by the totals
+def print_diff(conn, from_time, to_time, path=None, summary_only=False):
+    print(f"Changes from {from_time} to {to_time}" + (f" in {path}" if path else "") + ":")
+    totals = {'added': [0, 0], 'modified': [0, 0], 'removed': [0, 0]}  # Change -> [files, bytes]
+    modified_old_bytes = 0
+    for change, source, old, new in diff_snapshots(conn, from_time, to_time, path):
+        size = old[3] if change == 'removed' else new[3]
+        totals[change][0] += 1
+        totals[change][1] += size
+        if change == 'modified':
+            modified_old_bytes += old[3]
+        if summary_only:
+            continue
+        if change == 'added':
+            print(f"+ {source} ({size} bytes)")
+        elif change == 'removed':
+            print(f"- {source} ({size} bytes)")
+        else:
+            print(f"M {source} ({old[3]} -> {size} bytes)")
+    print(f"Added {totals['added'][0]} files ({totals['added'][1] / 1e6:.1f} MB), "
+          f"modified {totals['modified'][0]} files ({modified_old_bytes / 1e6:.1f} MB -> "
+          f"{totals['modified'][1] / 1e6:.1f} MB), removed {totals['removed'][0]} files "
+          f"({totals['removed'][1] / 1e6:.1f} MB).")
+
+# Function to print the versions and deletions of the files equal to a path or inside it, one file at a time
+# Each version is in the backup runs from the one that saved it up to the next version or deletion.
+def print_history(conn, path):
+    current_source = None
+    for source, date_time, version_id, size, file_hash, hash_algorithm, storage in iter_path_history(conn, path):
+        if source != current_source:
+            print(source)
+            current_source = source
+        if version_id is None:
+            print(f"  {date_time}  deleted")
+        else:
+            print(f"  {date_time}  {size:>12} bytes  {hash_algorithm} {file_hash[:16]}  {storage or 'file'}")
+    if current_source is None:
+        print(f"No backup history for {path}.")
+
+
+if __name__ == "__main__":
+    # Import the configuration
+    if str(os.name) == 'nt':
+        from backup_config_windows import backup_base_dir, home_dir
+    else:
+        from backup_config import backup_base_dir, home_dir
+
+    parser = argparse.ArgumentParser(description="Query the backup history in the catalog.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('snapshots', help="list the backup runs with the number and size of the files saved")
+    diff_parser = commands.add_parser('diff', help="list the files added, modified and removed between two runs")
+    diff_parser.add_argument('runs', nargs='*', type=parse_point_in_time, metavar='WHEN',
+                             help="the backup runs (or dates and times) to compare: by default the last two runs, "
+                                  "or the given run and the latest")
+    diff_parser.add_argument('--path', metavar='PATH',
+                             help="only compare this file or directory (relative to home_dir, or absolute)")
+    diff_parser.add_argument('--summary', action='store_true', help="only print the totals")
+    history_parser = commands.add_parser('history', help="list the backed up versions of a file or directory")
+    history_parser.add_argument('path', help="the file or directory (relative to home_dir, or absolute)")
+    args = parser.parse_args()
+
+    conn = open_catalog(backup_base_dir)
+    import_text_databases(conn, backup_base_dir)
+
+    if args.command == 'snapshots':
+        print_snapshots(conn)
+    elif args.command == 'diff':
+        if len(args.runs) > 2:
+            parser.error("diff takes at most two backup runs")
+        if len(args.runs) == 2:
+            from_time, to_time = (_resolve_snapshot(conn, when) for when in args.runs)
+        elif len(args.runs) == 1:
+            from_time, to_time = _resolve_snapshot(conn, args.runs[0]), snapshot_at(conn)
+        else:
+            backup_times = list_snapshot_times(conn)[-2:]
+            if len(backup_times) < 2:
+                print("There are fewer than two backup runs to compare.")
+                sys.exit(1)
+            from_time, to_time = backup_times
+        path = os.path.normpath(os.path.join(home_dir, args.path)) if args.path else None
+        print_diff(conn, from_time, to_time, path, args.summary)
+    else:
+        print_history(conn, os.path.normpath(os.path.join(home_dir, args.path)))
+
+    conn.close()
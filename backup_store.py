@@ -0,0 +1,47 @@
+import os
+import threading
+
+# Name of the directory holding the content-addressed objects, inside the backup base directory
+OBJECTS_DIR_NAME = 'objects'
+
+# Function to get the path of the object holding the file content with the given hash
+def object_path(backup_base_dir, content_hash):
+    # Spread the objects over 256 subdirectories to keep directory sizes manageable
+    return os.path.join(backup_base_dir, OBJECTS_DIR_NAME, content_hash[:2], content_hash)
+
+# Function to get a temporary file name next to a target file, unique to the calling thread
+def temporary_path(target_path):
+    return f"{target_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+
+# Function to get a temporary file name inside the object store, for content whose hash is not known yet
+# or that may not be kept
+# It is on the same file system as the objects, so it can be renamed into place
+def object_temp_path(backup_base_dir):
+    temp_dir = os.path.join(backup_base_dir, OBJECTS_DIR_NAME, 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, f"{os.getpid()}-{threading.get_ident()}")
+
+# Function to move a fully written temporary file into the object store, unless its content is already stored
+# Returns the object path and whether the content was added
+def commit_object(backup_base_dir, temp_file, content_hash):
+    object_file = object_path(backup_base_dir, content_hash)
+    if os.path.exists(object_file):
+        os.remove(temp_file)
+        return object_file, False
+
+    os.makedirs(os.path.dirname(object_file), exist_ok=True)
+    os.replace(temp_file, object_file)
+    return object_file, True
+
+# Function to add a stored object to a snapshot directory tree as a hardlink
+# Returns False if the backup file system does not support hardlinks
+def link_object(object_file, backup_file):
+    os.makedirs(os.path.dirname(backup_file), exist_ok=True)
+    try:
+        os.link(object_file, backup_file)
+    except FileExistsError:
+        os.remove(backup_file)
+        os.link(object_file, backup_file)
+    except OSError:
+        return False
+    return True
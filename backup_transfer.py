@@ -0,0 +1,111 @@
+import os
+import sys
+import errno
+import shutil
+import threading
+
+from backup_hash import LEGACY_ALGORITHM, new_hashers, hash_open_file
+
+# Size of the reusable buffer used when the data is copied through Python
+BUFFER_SIZE = 1024 * 1024
+
+# ioctl request to clone (reflink) a whole file on btrfs and XFS
+FICLONE = 0x40049409
+
+# Errors meaning a copy method is not supported for this pair of files, so the next one should be tried
+_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                       getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+
+_thread_buffers = threading.local()
+
+# Function to get this thread's reusable copy buffer
+def _get_buffer():
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_buffers.buffer = bytearray(BUFFER_SIZE)
+    return buffer
+
+# Function to clone a file by sharing its blocks (copy-on-write file systems only)
+def _reflink(source_fd, destination_fd, size):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are only supported on Linux")
+    import fcntl
+    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+# Function to copy a file inside the kernel with copy_file_range
+def _copy_file_range(source_fd, destination_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(source_fd, destination_fd, size - copied)
+        if count == 0:
+            break
+        copied += count
+
+# Function to copy a file inside the kernel with sendfile
+# Only Linux can send to a file; elsewhere (macOS, the BSDs) sendfile only writes to sockets
+def _sendfile(source_fd, destination_fd, size):
+    if not sys.platform.startswith('linux') or not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, "sendfile to a file is only supported on Linux")
+    copied = 0
+    while copied < size:
+        count = os.sendfile(destination_fd, source_fd, copied, size - copied)
+        if count == 0:
+            break
+        copied += count
+
+# Kernel-side copy methods, best first
+KERNEL_COPY_METHODS = [('reflink', _reflink), ('copy_file_range', _copy_file_range), ('sendfile', _sendfile)]
+
+# Function to copy a file while hashing it, reading the source only once
+# The hash with hash_path prefixed (as in calculate_source_hashes) and the hash of the content alone are
+# returned along with the copy method used. When the kernel copies the data, the destination is read back
+# to hash it, so the hashes always describe what landed on disk; otherwise the data is hashed as it is
+# written from one reusable buffer. With a compressor (see backup_compress), the data is compressed as it is
+# written, and the hashes are still those of the uncompressed data. hash_algorithm is one of those in backup_hash.
+def copy_with_hash(source_file, destination_file, hash_path=None, kernel_copy=True, compressor=None,
+                   hash_algorithm=LEGACY_ALGORITHM):
+    with open(source_file, 'rb') as src, open(destination_file, 'w+b') as dst:
+        size = os.fstat(src.fileno()).st_size
+        method = None
+        if kernel_copy and size > 0 and compressor is None:
+            for name, copy_method in KERNEL_COPY_METHODS:
+                try:
+                    copy_method(src.fileno(), dst.fileno(), size)
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_ERRORS:
+                        raise
+                    # Start again with the next method
+                    dst.seek(0)
+                    dst.truncate()
+                    src.seek(0)
+                    continue
+                if os.fstat(dst.fileno()).st_size == size:
+                    method = name
+                    break
+                dst.seek(0)
+                dst.truncate()
+                src.seek(0)
+
+        if method is not None:
+            dst.seek(0)
+            hashes = hash_open_file(dst, hash_algorithm, hash_path)
+        else:
+            method = 'buffered' if compressor is None else 'compressed'
+            path_hasher, content_hasher = new_hashers(hash_algorithm, hash_path)
+            buffer = _get_buffer()
+            view = memoryview(buffer)
+            while True:
+                count = src.readinto(buffer)
+                if not count:
+                    break
+                dst.write(view[:count] if compressor is None else compressor.compress(view[:count]))
+                path_hasher.update(view[:count])
+                content_hasher.update(view[:count])
+            if compressor is not None:
+                dst.write(compressor.flush())
+            hashes = path_hasher.hexdigest(), content_hasher.hexdigest()
+
+    shutil.copystat(source_file, destination_file)
+    return hashes[0], hashes[1], method
@@ -0,0 +1,201 @@
+import os
+import time
+import datetime
+import threading
+import concurrent.futures
+
+from backup_compress import DECOMPRESSION_ERRORS
+from backup_hash import LEGACY_ALGORITHM
+from backup_store import object_path
+
+# Number of verification results saved to the catalog at a time, so an interrupted run loses little work
+COMMIT_INTERVAL = 100
+
+# Number of versions read from the catalog at a time
+BATCH_SIZE = 1000
+
+# Number of files being verified or waiting for a thread, per thread
+JOBS_PER_WORKER = 4
+
+# Class to cap the total read rate of all verification threads (a token bucket)
+class BandwidthLimiter:
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Function to wait until num_bytes more may be read
+    def throttle(self, num_bytes):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.bytes_per_second,
+                                 self.allowance + (now - self.last_time) * self.bytes_per_second)
+            self.last_time = now
+            self.allowance -= num_bytes
+            wait = -self.allowance / self.bytes_per_second if self.allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+# Function to get the stat signature of a backup file, or None if it is missing
+def backup_file_signature(backup_file):
+    try:
+        stat_result = os.stat(backup_file)
+    except OSError:
+        return None
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+# Function to get the stat signature of a chunked backup file: the total size of its manifest and chunks and the
+# latest modification time among them, or None if the manifest or any of its chunks is missing
+def chunked_file_signature(conn, backup_base_dir, version_id, manifest_file):
+    signature = backup_file_signature(manifest_file)
+    if signature is None:
+        return None
+    size, mtime_ns = signature
+    for (chunk_hash,) in conn.execute("SELECT DISTINCT chunk_hash FROM chunks WHERE version_id = ?", (version_id,)):
+        chunk_signature = backup_file_signature(object_path(backup_base_dir, chunk_hash))
+        if chunk_signature is None:
+            return None
+        size += chunk_signature[0]
+        mtime_ns = max(mtime_ns, chunk_signature[1])
+    return size, mtime_ns
+
+# Columns of a version to verify, with the result of its last verification if any
+_VERIFY_COLUMNS = "v.id, v.source, v.backup_file, v.hash, v.storage, v.pack_offset, v.pack_length, v.compression, " \
+                  "v.hash_algorithm, r.hash_match, r.size, r.mtime_ns"
+
+# Function to list the versions to verify, with the result of their last verification if any
+# The versions are read in batches in id order, so the list is never all in memory and no query is left open
+# while results are saved.
+def _versions_to_verify(conn, latest_only, version_ids=None):
+    if version_ids is not None:
+        for i in range(0, len(version_ids), BATCH_SIZE):
+            batch = version_ids[i:i + BATCH_SIZE]
+            yield from conn.execute(
+                f"SELECT {_VERIFY_COLUMNS} FROM file_versions v LEFT JOIN verifications r ON r.version_id = v.id "
+                f"WHERE v.id IN ({','.join('?' * len(batch))})", batch).fetchall()
+        return
+    if latest_only:
+        # The latest versions are the ones not superseded yet, which the superseded_at index lists in id order
+        query = (f"SELECT {_VERIFY_COLUMNS} FROM file_versions v LEFT JOIN verifications r ON r.version_id = v.id "
+                 "WHERE v.superseded_at IS NULL AND v.id > ? ORDER BY v.id LIMIT ?")
+    else:
+        query = (f"SELECT {_VERIFY_COLUMNS} FROM file_versions v LEFT JOIN verifications r ON r.version_id = v.id "
+                 "WHERE v.id > ? ORDER BY v.id LIMIT ?")
+    last_id = 0
+    while True:
+        rows = conn.execute(query, (last_id, BATCH_SIZE)).fetchall()
+        yield from rows
+        if len(rows) < BATCH_SIZE:
+            return
+        last_id = rows[-1][0]
+
+# Function to check the hashes of backup files, skipping files verified before and unchanged since
+# hash_version(version, throttle) must return the hash of one backup file, where version is a dictionary with
+# the source, backup_file, storage, pack_offset, pack_length, compression and hash_algorithm of the file version.
+# With version_ids, only those versions are checked (such as the versions a restore will use).
+# A chunked file counts as unchanged only if its manifest and all its chunks in backup_base_dir are; without
+# backup_base_dir, chunked files are always checked again.
+# Only a few files per thread are in progress at a time, and each result is saved as soon as it is known.
+# Returns a dictionary of version id -> True if the hash matched.
+def verify_catalog(conn, hash_version, workers=4, bandwidth_limit=0, latest_only=False, force=False,
+                   version_ids=None, backup_base_dir=None):
+    limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+    throttle = limiter.throttle if limiter else None
+    workers = max(1, workers)
+    results = {}
+    num_checked = 0
+    pending = 0
+
+    def verify_job(job):
+        version_id, version, saved_hash, signature = job
+        try:
+            return version_id, hash_version(version, throttle) == saved_hash, signature
+        except (OSError, ValueError) + DECOMPRESSION_ERRORS:
+            # A missing or unreadable file, a damaged chunk manifest or damaged compressed data fails the check
+            return version_id, False, signature
+
+    # Function to save the results of the finished checks, committing now and then
+    def save_results(futures):
+        nonlocal pending
+        for future in futures:
+            version_id, hash_match, signature = future.result()
+            results[version_id] = hash_match
+            conn.execute(
+                "INSERT OR REPLACE INTO verifications (version_id, hash_match, size, mtime_ns, verified_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (version_id, int(hash_match), signature[0], signature[1],
+                 datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            pending += 1
+            if pending >= COMMIT_INTERVAL:
+                conn.commit()
+                pending = 0
+
+    in_progress = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for version_id, source, backup_file, saved_hash, storage, pack_offset, pack_length, compression, \
+                hash_algorithm, last_match, last_size, last_mtime_ns in _versions_to_verify(conn, latest_only,
+                                                                                             version_ids):
+            if storage == 'chunked' and backup_base_dir is not None:
+                signature = chunked_file_signature(conn, backup_base_dir, version_id, backup_file)
+            else:
+                signature = backup_file_signature(backup_file)
+            if signature is None:
+                results[version_id] = False  # The backup file (or one of its chunks) is missing
+            elif not force and last_match is not None and signature == (last_size, last_mtime_ns) \
+                    and (storage != 'chunked' or backup_base_dir is not None):
+                results[version_id] = bool(last_match)  # Verified before and unchanged since
+            else:
+                if num_checked == 0:
+                    print("Verifying backup files...")
+                version = {'source': source, 'backup_file': backup_file, 'storage': storage or 'file',
+                           'pack_offset': pack_offset, 'pack_length': pack_length, 'compression': compression,
+                           'hash_algorithm': hash_algorithm or LEGACY_ALGORITHM}
+                in_progress.add(pool.submit(verify_job, (version_id, version, saved_hash, signature)))
+                num_checked += 1
+                if len(in_progress) >= workers * JOBS_PER_WORKER:
+                    # Wait for a file to finish before reading more of the catalog
+                    done, in_progress = concurrent.futures.wait(
+                        in_progress, return_when=concurrent.futures.FIRST_COMPLETED)
+                    save_results(done)
+        while in_progress:
+            done, in_progress = concurrent.futures.wait(in_progress, return_when=concurrent.futures.FIRST_COMPLETED)
+            save_results(done)
+    conn.commit()
+
+    if num_checked:
+        print(f"Checked {num_checked} backup files ({len(results) - num_checked} verified before and unchanged "
+              "or missing).")
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    from backup import hash_backup_version
+    from backup_catalog import open_catalog, import_text_databases
+
+    # Import the configuration
+    if str(os.name) == 'nt':
+        from backup_config_windows import backup_base_dir, verify_workers, verify_bandwidth_limit, verify_latest_only
+    else:
+        from backup_config import backup_base_dir, verify_workers, verify_bandwidth_limit, verify_latest_only
+
+    parser = argparse.ArgumentParser(description="Check the hashes of backup files.")
+    parser.add_argument('--workers', type=int, default=verify_workers, help="number of hashing threads")
+    parser.add_argument('--bandwidth', type=float, default=verify_bandwidth_limit / 1e6,
+                        help="maximum read rate in MB/s (0 for no limit)")
+    parser.add_argument('--latest-only', action='store_true', default=verify_latest_only,
+                        help="only verify the latest version of each file")
+    parser.add_argument('--force', action='store_true', help="verify files even if verified before")
+    args = parser.parse_args()
+
+    conn = open_catalog(backup_base_dir)
+    import_text_databases(conn, backup_base_dir)
+    results = verify_catalog(
+        conn,
+        lambda version, throttle: hash_backup_version(backup_base_dir, version, throttle),
+        args.workers, int(args.bandwidth * 1e6), args.latest_only, args.force, backup_base_dir=backup_base_dir)
+    conn.close()
+
+    num_failed = sum(1 for hash_match in results.values() if not hash_match)
+    print(f"Verified {len(results)} backup files, {num_failed} failed.")
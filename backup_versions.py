@@ -0,0 +1,67 @@
+import os
+import sys
+import datetime
+
+from backup_hash import binary_digest, hex_digest
+
+# Class to hold one backed up version of a file compactly, for catalogs with millions of versions
+# Fields are slots rather than a dictionary; the backup directory and file name are interned, so the many
+# versions in one directory (and the versions of one file) share them; the hash is kept as a binary digest
+# and the modification time as integer microseconds. The stored size is only kept when it differs from the size.
+# date_time is the run (snapshot) the version was saved in, shared by all the versions of that run.
+# Versions are read like the dictionaries list_all_backups used to return: version['backup_file'],
+# version.get('storage'), and so on.
+class BackupVersion:
+    __slots__ = ('backup_dir', 'backup_name', 'mtime_us', 'size', 'digest', 'hash_algorithm', 'hash_match',
+                 'storage', 'pack_offset', 'pack_length', 'compression', '_stored_size', 'date_time')
+
+    # Keys that can be read with version[key] or version.get(key)
+    KEYS = ('backup_file', 'mod_time', 'size', 'md5_hash', 'hash_algorithm', 'hash_match', 'storage',
+            'pack_offset', 'pack_length', 'compression', 'stored_size', 'date_time')
+
+    def __init__(self, backup_file, mtime, size, file_hash, hash_algorithm, hash_match=None, storage=None,
+                 pack_offset=None, pack_length=None, compression=None, stored_size=None, date_time=None):
+        backup_dir, backup_name = os.path.split(backup_file)
+        self.backup_dir = sys.intern(backup_dir)
+        self.backup_name = sys.intern(backup_name)
+        self.mtime_us = round(mtime * 1000000)
+        self.size = size
+        self.digest = binary_digest(file_hash)
+        self.hash_algorithm = sys.intern(hash_algorithm)
+        self.hash_match = hash_match
+        self.storage = sys.intern(storage or 'file')
+        self.pack_offset = pack_offset
+        self.pack_length = pack_length
+        self.compression = sys.intern(compression) if compression else None
+        self._stored_size = None if stored_size == size else stored_size
+        self.date_time = sys.intern(date_time) if date_time else None
+
+    @property
+    def backup_file(self):
+        return os.path.join(self.backup_dir, self.backup_name)
+
+    @property
+    def mod_time(self):
+        return datetime.datetime.fromtimestamp(self.mtime_us / 1000000)
+
+    @property
+    def md5_hash(self):
+        return hex_digest(self.digest)
+
+    @property
+    def stored_size(self):
+        return self.size if self._stored_size is None else self._stored_size
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.KEYS else default
+
+    def keys(self):
+        return self.KEYS
+
+    def __repr__(self):
+        return f"BackupVersion({dict(self)!r})"
@@ -0,0 +1,177 @@
+import os
+import re
+import stat
+import logging
+
+# Characters that make an exclusion rule a glob pattern rather than a plain path or name
+GLOB_CHARACTERS = '*?['
+
+# Function to turn a glob pattern into a regular expression, where ** matches across directories
+def _glob_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                regex += '[' + pattern[i + 1:end].replace('\\', '\\\\') + ']'
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+# Function to put a path in the form the exclusion rules are matched against
+def _normalise(path):
+    return os.path.normcase(path).replace(os.sep, '/')
+
+# Class to match paths against the excluded_dirs rules, compiled once per backup run
+# A rule can be:
+# - an absolute path, excluding that directory (or file) and everything below it
+# - a name such as '.cache', excluding every file or directory with that name
+# - a glob pattern without a separator such as '*.tmp', matched against each name
+# - a glob pattern with a separator such as '**/node_modules', matched against the whole path
+class ExclusionMatcher:
+    def __init__(self, excluded_dirs):
+        self.trie = {}  # Nested dictionaries of path components; a None key marks an excluded path
+        self.names = set()
+        name_patterns = []
+        path_patterns = []
+
+        for rule in excluded_dirs:
+            if os.path.isabs(rule) and not any(c in rule for c in GLOB_CHARACTERS):
+                node = self.trie
+                for part in _normalise(os.path.normpath(rule)).strip('/').split('/'):
+                    node = node.setdefault(part, {})
+                node[None] = True
+                continue
+            is_absolute = os.path.isabs(rule)
+            rule = _normalise(rule)
+            if '/' not in rule.rstrip('/'):
+                rule = rule.rstrip('/')
+                if any(c in rule for c in GLOB_CHARACTERS):
+                    name_patterns.append(_glob_to_regex(rule))
+                else:
+                    self.names.add(rule)
+            else:
+                # Absolute patterns match from the root, relative ones at any directory level
+                anchor = '^' if is_absolute else '(?:^|/)'
+                path_patterns.append(anchor + _glob_to_regex(rule.rstrip('/')))
+
+        self.name_regex = re.compile('|'.join(f'(?:{p})' for p in name_patterns) + r'\Z') if name_patterns else None
+        self.path_regex = re.compile('|'.join(f'(?:{p})' for p in path_patterns) + r'\Z') if path_patterns else None
+
+    # Function to find the trie node for a directory, or None if no absolute rule is below it
+    def trie_node(self, path):
+        node = self.trie
+        for part in _normalise(os.path.normpath(path)).strip('/').split('/'):
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+
+    # Function to check a directory entry, given the trie node of its parent directory
+    def is_excluded(self, path, name, parent_node):
+        if parent_node is not None:
+            child = parent_node.get(_normalise(name))
+            if child is not None and None in child:
+                return True
+        name = _normalise(name)
+        if name in self.names:
+            return True
+        if self.name_regex is not None and self.name_regex.match(name):
+            return True
+        if self.path_regex is not None and self.path_regex.search(_normalise(path)):
+            return True
+        return False
+
+    # Function to check a path given on its own, by checking it and each directory above it
+    def is_path_excluded(self, path):
+        path = os.path.normpath(path)
+        chain = []
+        while True:
+            head, name = os.path.split(path)
+            if not name:
+                break
+            chain.append((path, name))
+            path = head
+        node = self.trie if not _normalise(path).strip('/') else self.trie_node(path)
+        for entry_path, name in reversed(chain):
+            if self.is_excluded(entry_path, name, node):
+                return True
+            node = node.get(_normalise(name)) if node is not None else None
+        return False
+
+# Function to group the source directories by the device (disk) they are on, keeping their order
+# Returns a dictionary of device -> list of source directories; a directory that cannot be read is in a group of
+# its own, so the walk reports it.
+def group_by_device(source_dirs):
+    groups = {}
+    for source_dir in source_dirs:
+        try:
+            device = os.stat(source_dir).st_dev
+        except OSError:
+            device = source_dir
+        groups.setdefault(device, []).append(source_dir)
+    return groups
+
+# Function to walk the source directories with os.scandir, yielding (file path, stat result) for each file
+# Excluded directories are never entered. The stat result is passed on so the file is not stat'ed again.
+# Each directory is finished before the next is started, and its files are given in inode order, which on most
+# file systems is close to the order of the files on the disk, so a spinning disk seeks less.
+def walk_files(source_dirs, matcher):
+    for source_dir in source_dirs:
+        # Each item on the stack is a directory and its node in the exclusion trie
+        stack = [(source_dir, matcher.trie_node(source_dir))]
+        while stack:
+            directory, node = stack.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                error_msg = f"Error: Cannot read directory {directory}: {e}"
+                print(error_msg)
+                logging.error(error_msg)
+                continue
+
+            subdirectories = []
+            files = []
+            for entry in entries:
+                if matcher.is_excluded(entry.path, entry.name, node):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append((entry.path, node.get(_normalise(entry.name)) if node else None))
+                        continue
+                    stat_result = entry.stat()
+                except OSError as e:
+                    error_msg = f"Error: Cannot read {entry.path}: {e}"
+                    print(error_msg)
+                    logging.error(error_msg)
+                    continue
+                # A symbolic link to a directory is neither followed nor backed up, as with os.walk
+                if stat.S_ISDIR(stat_result.st_mode):
+                    continue
+                files.append((entry.path, stat_result))
+
+            # Windows gives no inode numbers here (they are all 0), leaving the files in name order
+            files.sort(key=lambda item: (item[1].st_ino, item[0]))
+            yield from files
+
+            # Visit subdirectories in name order, as the stack pops them from the end
+            subdirectories.sort(reverse=True)
+            stack.extend(subdirectories)
@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import stat
+import errno
+import struct
+import logging
+
+# Files kept in the backup base directory:
+# the journal of changed paths written by the watcher, the watcher's status (its session and process id),
+# and the session of the journal consumed by the last successful backup
+JOURNAL_FILE_NAME = 'change_journal.txt'
+CONSUMING_FILE_NAME = 'change_journal.consuming'
+STATUS_FILE_NAME = 'change_watcher.txt'
+STATE_FILE_NAME = 'change_journal_state.txt'
+
+# inotify event flags (from <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# Layout of the fixed part of struct inotify_event: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+# How often the watcher writes the paths it has collected to the journal, in seconds
+FLUSH_INTERVAL = 1.0
+
+# Function to append records to the journal, starting a new journal with the session header if needed
+# The journal is locked while writing, so a backup never reads a half written batch
+def append_to_journal(backup_base_dir, session, records):
+    import fcntl
+    journal_file = os.path.join(backup_base_dir, JOURNAL_FILE_NAME)
+    while True:
+        with open(journal_file, 'a', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # A backup may have taken the journal away while we waited for the lock
+            try:
+                if os.stat(journal_file).st_ino != os.fstat(f.fileno()).st_ino:
+                    continue
+            except FileNotFoundError:
+                continue
+            if f.tell() == 0:
+                f.write(json.dumps(['SESSION', session]) + '\n')
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            return
+
+# Class to watch the source directories with inotify and record changed paths in the journal
+class ChangeWatcher:
+    def __init__(self, source_dirs, backup_base_dir, matcher):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.ctypes = ctypes
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.source_dirs = source_dirs
+        self.backup_base_dir = backup_base_dir
+        self.matcher = matcher
+        self.paths = {}  # Watch descriptor -> directory path
+        self.session = f"{int(time.time())}-{os.getpid()}"
+        self.pending = {}  # Path -> record, collected between flushes
+        self.overflowed = False
+
+    # Function to watch a directory and all the directories below it
+    def add_tree(self, top_dir):
+        stack = [top_dir]
+        while stack:
+            directory = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                err = self.ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    # Out of inotify watches: changes below here would be missed
+                    logging.error(f"Error: inotify watch limit reached at {directory}")
+                    self.overflowed = True
+                continue
+            self.paths[wd] = directory
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and \
+                                not self.matcher.is_path_excluded(entry.path):
+                            stack.append(entry.path)
+            except OSError:
+                pass
+
+    # Function to stop watching a directory tree that has been moved away or deleted
+    def remove_tree(self, top_dir):
+        prefix = top_dir + os.sep
+        for wd, directory in list(self.paths.items()):
+            if directory == top_dir or directory.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    # Function to record a changed path, keeping only the latest record per path between flushes
+    def record(self, kind, path):
+        if self.matcher.is_path_excluded(path):
+            return
+        self.pending[path] = [kind, path]
+
+    # Function to handle one inotify event
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self.paths.pop(wd, None)
+            return
+        directory = self.paths.get(wd)
+        if directory is None:
+            return
+        path = os.path.join(directory, name) if name else directory
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # A new directory: watch it and have the backup walk all of it
+                if not self.matcher.is_path_excluded(path):
+                    self.add_tree(path)
+                    self.record('D', path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.remove_tree(path)
+                self.record('X', path)
+        elif mask & (IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO):
+            self.record('F', path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.record('X', path)
+
+    # Function to write the collected records to the journal
+    def flush(self):
+        records = list(self.pending.values())
+        if self.overflowed:
+            records.append(['OVERFLOW'])
+            self.overflowed = False
+        if records:
+            append_to_journal(self.backup_base_dir, self.session, records)
+        self.pending = {}
+
+    # Function to watch for changes until the process is stopped
+    def run(self):
+        import select
+        for source_dir in self.source_dirs:
+            self.add_tree(source_dir)
+
+        # Announce the session once every directory is watched; backups trust the journal from the next run
+        status_file = os.path.join(self.backup_base_dir, STATUS_FILE_NAME)
+        with open(status_file + '.tmp', 'w') as f:
+            json.dump({'session': self.session, 'pid': os.getpid()}, f)
+        os.replace(status_file + '.tmp', status_file)
+        print(f"Watching {len(self.paths)} directories (session {self.session}).")
+        logging.info(f"Change watcher started, session {self.session}, {len(self.paths)} directories")
+
+        last_flush = time.monotonic()
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], FLUSH_INTERVAL)
+            if ready:
+                data = os.read(self.fd, 256 * 1024)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                    offset += EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+                    offset += name_length
+                    self.handle_event(wd, mask, name)
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                self.flush()
+                last_flush = time.monotonic()
+
+# Function to read a small JSON file, or None if it is missing or damaged
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Function to check whether a process is still running
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# Function to take the journal of changes made since the last backup
+# Returns (session, changes) where changes is None if the journal cannot be trusted and the whole tree has
+# to be walked: the watcher is not running, was restarted since the last backup, or missed events.
+# Otherwise changes is a dictionary with the sets of changed 'files', new 'dirs' and 'deleted' paths.
+def consume_change_journal(backup_base_dir):
+    if not sys.platform.startswith('linux'):
+        return None, None
+    import fcntl
+
+    status = _read_json(os.path.join(backup_base_dir, STATUS_FILE_NAME))
+    session = status.get('session') if status and _process_alive(status.get('pid', 0)) else None
+    state = _read_json(os.path.join(backup_base_dir, STATE_FILE_NAME)) or {}
+    trusted = session is not None and state.get('session') == session
+
+    # Forget the consumed session until this backup completes, so a failed run leads to a full walk
+    _write_state(backup_base_dir, None)
+
+    # Take the journal away from the watcher, which starts a new one on its next write
+    journal_file = os.path.join(backup_base_dir, JOURNAL_FILE_NAME)
+    consuming_file = os.path.join(backup_base_dir, CONSUMING_FILE_NAME)
+    lines = []
+    if os.path.exists(journal_file):
+        with open(journal_file, 'r', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            os.replace(journal_file, consuming_file)
+            lines = f.readlines()
+        os.remove(consuming_file)
+
+    changes = {'files': set(), 'dirs': set(), 'deleted': set()}
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            trusted = False
+            continue
+        kind = record[0]
+        if kind == 'SESSION':
+            trusted = trusted and record[1] == session
+        elif kind == 'OVERFLOW':
+            trusted = False
+        elif kind == 'F':
+            changes['files'].add(record[1])
+            changes['deleted'].discard(record[1])
+        elif kind == 'D':
+            changes['dirs'].add(record[1])
+            changes['deleted'].discard(record[1])
+        elif kind == 'X':
+            changes['deleted'].add(record[1])
+            changes['files'].discard(record[1])
+            changes['dirs'].discard(record[1])
+
+    return session, changes if trusted else None
+
+# Function to save the session whose journal has been fully backed up
+def _write_state(backup_base_dir, session):
+    state_file = os.path.join(backup_base_dir, STATE_FILE_NAME)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump({'session': session}, f)
+    os.replace(state_file + '.tmp', state_file)
+
+# Function to record, after a successful backup, that changes up to now have been backed up
+def commit_change_journal(backup_base_dir, session):
+    _write_state(backup_base_dir, session)
+
+# Function to check whether a path is inside one of a set of directories
+def _is_inside(path, directories):
+    parent = os.path.dirname(path)
+    while parent != os.path.dirname(parent):
+        if parent in directories:
+            return True
+        parent = os.path.dirname(parent)
+    return parent in directories
+
+# Function to list the files to back up from the journal: changed files plus everything in new directories
+# Changed files and new directories inside another new directory are found by walking it, so they are left out
+# here and each file is listed once.
+def walk_changes(changes, matcher, walk_files):
+    for path in sorted(changes['files']):
+        if _is_inside(path, changes['dirs']) or matcher.is_path_excluded(path):
+            continue
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            continue  # Deleted again since
+        if not stat.S_ISDIR(stat_result.st_mode):
+            yield path, stat_result
+    new_dirs = sorted(directory for directory in changes['dirs'] if not _is_inside(directory, changes['dirs']))
+    for directory in new_dirs:
+        if not os.path.isdir(directory) or matcher.is_path_excluded(directory):
+            continue
+        yield from walk_files([directory], matcher)
+
+if __name__ == "__main__":
+    from backup_walk import ExclusionMatcher
+
+    # Import the configuration
+    if str(os.name) == 'nt':
+        from backup_config_windows import source_dirs, backup_base_dir, excluded_dirs
+    else:
+        from backup_config import source_dirs, backup_base_dir, excluded_dirs
+
+    if not sys.platform.startswith('linux'):
+        print("The change watcher needs Linux (inotify).")
+        sys.exit(1)
+
+    # Configure the logging
+    log_file = os.path.join(backup_base_dir, 'backup_log.txt')
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    watcher = ChangeWatcher(source_dirs, backup_base_dir, ExclusionMatcher(excluded_dirs))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.flush()
@@ -1,14 +1,25 @@
 import os
+import sys
+import time
 import logging
+import argparse
+import threading
+import concurrent.futures
 
-from backup import list_all_backups
+from backup import list_all_backups, list_backups_at, iter_backup_data, configure_logging
+from backup_catalog import parse_point_in_time
+from backup_compress import DECOMPRESSION_ERRORS
+from backup_hash import LEGACY_ALGORITHM, new_hasher, hash_file
+from backup_metrics import RunMetrics, append_metrics_log, profiled
 # from restore_gui import create_window, make_backup_table, display_backup_table
 
 # Import the configuration
 if str(os.name) == 'nt':
-    from backup_config_windows import backup_base_dir, home_dir, restore_dir 
+    from backup_config_windows import backup_base_dir, home_dir, restore_dir, restore_workers, \
+        verify_workers, verify_bandwidth_limit, verify_latest_only
 else:
-    from backup_config import backup_base_dir, home_dir, restore_dir
+    from backup_config import backup_base_dir, home_dir, restore_dir, restore_workers, \
+        verify_workers, verify_bandwidth_limit, verify_latest_only
 
 # Function to check if a directory path exists and has necessary permissions
 def check_directory(path, write=False):
@@ -29,13 +40,6 @@ def check_directory(path, write=False):
         return False
     return True
 
-# Check if backup directory exists and has necessary permissions
-
-if not check_directory(backup_base_dir, write=True):
-    print("Please check backup base directory path and write permissions.")
-    logging.error("Error: Backup base directory path or write permissions are invalid.")
-    exit(1)
-
 # Function to print and save the backup information
 def print_and_save_backup_info(backup_info, output_file):
     with open(output_file, 'w') as f:
@@ -45,7 +49,7 @@ def print_and_save_backup_info(backup_info, output_file):
                 f.write(f"Backup {i + 1} Location: {backup['backup_file']}\n")
                 f.write(f"Modified Time: {backup['mod_time']}\n")
                 f.write(f"Size: {backup['size']} bytes\n")
-                f.write(f"MD5 Hash: {backup['md5_hash']}\n")
+                f.write(f"{backup['hash_algorithm'].upper()} Hash: {backup['md5_hash']}\n")
                 f.write(f"Hash Match: {backup['hash_match']}\n")
             f.write("\n")
 
@@ -56,11 +60,151 @@ def print_and_save_backup_info(backup_info, output_file):
             print(f"Backup {i + 1} Location: {backup['backup_file']}")
             print(f"Modified Time: {backup['mod_time']}")
             print(f"Size: {backup['size']} bytes")
-            print(f"MD5 Hash: {backup['md5_hash']}\n")
+            print(f"{backup['hash_algorithm'].upper()} Hash: {backup['md5_hash']}\n")
             print(f"Hash Match: {backup['hash_match']}")
         print()
 
 
+# Function to rebuild a chunked backup file from the chunks listed in its manifest
+def reassemble_file(backup_base_dir, manifest_file, destination_location):
+    with open(destination_location, 'wb') as f:
+        for data in iter_backup_data(manifest_file, 'chunked', backup_base_dir):
+            f.write(data)
+
+# Function to get the command line that makes a restore script call this script to reassemble a file
+def reassemble_command(manifest_file, destination_location):
+    return f'"{sys.executable}" "{os.path.abspath(__file__)}" --reassemble "{manifest_file}" "{destination_location}"'
+
+# Function to copy one member out of a pack file
+def extract_member(pack_file, pack_offset, pack_length, destination_location):
+    with open(destination_location, 'wb') as f:
+        for data in iter_backup_data(pack_file, 'packed', pack_offset=pack_offset, pack_length=pack_length):
+            f.write(data)
+
+# Function to get the command line that makes a restore script call this script to extract a packed file
+def extract_command(backup, destination_location):
+    return (f'"{sys.executable}" "{os.path.abspath(__file__)}" --extract "{backup["backup_file"]}" '
+            f'{backup["pack_offset"]} {backup["pack_length"]} "{destination_location}"')
+
+# Function to decompress a compressed backup file
+def decompress_file(compression, backup_file, destination_location):
+    with open(destination_location, 'wb') as f:
+        for data in iter_backup_data(backup_file, compression=compression):
+            f.write(data)
+
+# Function to get the command line that makes a restore script call this script to decompress a file
+def decompress_command(backup, destination_location):
+    return (f'"{sys.executable}" "{os.path.abspath(__file__)}" --decompress {backup["compression"]} '
+            f'"{backup["backup_file"]}" "{destination_location}"')
+
+# Function to pick the latest version of each file from the backup info
+def select_latest_versions(backup_info):
+    return [(source_location, backups[-1]) for source_location, backups in backup_info.items() if backups]
+
+# Function to check the hash of a file that is already in the restore directory
+def verify_restored_file(source_location, backup, destination_location):
+    try:
+        path_hash = hash_file(destination_location, backup.get('hash_algorithm', LEGACY_ALGORITHM),
+                              source_location)[0]
+    except OSError:
+        return False
+    return path_hash == backup['md5_hash']
+
+# Function to check whether a file already restored by an earlier, interrupted run can be skipped
+def is_already_restored(source_location, backup, destination_location, verify_existing):
+    try:
+        stat_result = os.stat(destination_location)
+    except OSError:
+        return False
+    # Restored files get the modification time of their backup, so size and time identify them
+    if stat_result.st_size != backup['size']:
+        return False
+    if abs(stat_result.st_mtime - backup['mod_time'].timestamp()) > 2:
+        return False
+    return not verify_existing or verify_restored_file(source_location, backup, destination_location)
+
+# Function to copy one backup file to its restore location, checking its hash as it is copied
+# Returns the number of bytes restored, or None if the file was already restored
+def restore_file(source_location, backup, destination_location, backup_base_dir, verify_existing):
+    if is_already_restored(source_location, backup, destination_location, verify_existing):
+        return None
+
+    # Write to a temporary file first, so an interrupted copy never looks like a restored file
+    temp_location = f"{destination_location}.restoring"
+    hasher = new_hasher(backup.get('hash_algorithm', LEGACY_ALGORITHM))
+    # Include the source file path in the hash, as the backup does
+    hasher.update(source_location.encode('utf-8'))
+    num_bytes = 0
+    try:
+        with open(temp_location, 'wb') as f:
+            for data in iter_backup_data(backup['backup_file'], backup.get('storage', 'file'), backup_base_dir,
+                                         pack_offset=backup.get('pack_offset'), pack_length=backup.get('pack_length'),
+                                         compression=backup.get('compression')):
+                hasher.update(data)
+                f.write(data)
+                num_bytes += len(data)
+        if hasher.hexdigest() != backup['md5_hash']:
+            raise ValueError(f"hash mismatch in {backup['backup_file']}")
+        mod_time = backup['mod_time'].timestamp()
+        os.utime(temp_location, (mod_time, mod_time))
+        os.replace(temp_location, destination_location)
+    finally:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+    return num_bytes
+
+# Function to restore files directly, copying with a pool of threads instead of generating a script
+# versions is a list of (source location, backup) pairs, e.g. from select_latest_versions
+def restore_files(versions, backup_base_dir, home_dir, restore_dir, workers=4, verify_existing=False, metrics=None):
+    start_time = time.time()
+    metrics = metrics or RunMetrics()
+
+    # Work out the destination of each file, and create each destination directory only once
+    jobs = []
+    destination_dirs = set()
+    for source_location, backup in versions:
+        relative_path = os.path.relpath(source_location, home_dir)
+        destination_location = os.path.join(restore_dir, relative_path)
+        destination_dirs.add(os.path.dirname(destination_location))
+        jobs.append((source_location, backup, destination_location))
+    for destination_dir in sorted(destination_dirs):
+        os.makedirs(destination_dir, exist_ok=True)
+
+    counts = {'restored': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    counts_lock = threading.Lock()
+
+    def restore_job(job):
+        source_location, backup, destination_location = job
+        job_start = time.perf_counter()
+        try:
+            num_bytes = restore_file(source_location, backup, destination_location, backup_base_dir,
+                                     verify_existing)
+        except (OSError, ValueError) + DECOMPRESSION_ERRORS as e:
+            error_msg = f"Error: {destination_location} restore failed: {e}"
+            print(error_msg)
+            logging.error(error_msg)
+            result = 'failed'
+            num_bytes = 0
+        else:
+            result = 'skipped' if num_bytes is None else 'restored'
+        with counts_lock:
+            counts[result] += 1
+            counts['bytes'] += num_bytes or 0
+        metrics.add(result, time.perf_counter() - job_start, destination_location, num_bytes or 0)
+        # Report progress every few seconds
+        metrics.progress()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # Consume the results so that unexpected exceptions are raised here
+        for _ in pool.map(restore_job, jobs):
+            pass
+
+    run_time = max(time.time() - start_time, 1e-6)
+    print(f"Restored {counts['restored']} files ({counts['bytes'] / 1e6:.1f} MB, "
+          f"{counts['bytes'] / run_time / 1e6:.1f} MB/s), skipped {counts['skipped']} already restored, "
+          f"{counts['failed']} failed.")
+    return counts
+
 def generate_restore_script(backup_info, script_file_path, home_dir, restore_dir):
     with open(script_file_path, 'w') as script_file:
         script_file.write('#!/bin/bash\n\n')
@@ -82,7 +226,14 @@ def generate_restore_script(backup_info, script_file_path, home_dir, restore_dir
                 script_file.write(f'if [ ! -d "{destination_dir}" ]; then\n')
                 script_file.write(f'    mkdir -p "{destination_dir}"\n')
                 script_file.write(f'fi\n')
-                script_file.write(f'cp "{backup_file}" "{destination_location}" ')
+                if latest_backup.get('storage') == 'chunked':
+                    script_file.write(reassemble_command(backup_file, destination_location) + ' ')
+                elif latest_backup.get('storage') == 'packed':
+                    script_file.write(extract_command(latest_backup, destination_location) + ' ')
+                elif latest_backup.get('compression'):
+                    script_file.write(decompress_command(latest_backup, destination_location) + ' ')
+                else:
+                    script_file.write(f'cp "{backup_file}" "{destination_location}" ')
                 script_file.write('|| {\n')
                 script_file.write('    exit_code=$?\n')
                 script_file.write(f'    echo "{destination_location} restore failed with exit code: $exit_code"\n')
@@ -114,7 +265,14 @@ def generate_windows_restore_script(backup_info, batch_file_path, home_dir, rest
                 destination_location = os.path.join(restore_dir, relative_path)
                 destination_dir = os.path.dirname(destination_location)
                 batch_file.write(f'if not exist "{destination_dir}" mkdir "{destination_dir}"\n')
-                batch_file.write(f'copy "{backup_file}" "{destination_location}"\n')
+                if latest_backup.get('storage') == 'chunked':
+                    batch_file.write(reassemble_command(backup_file, destination_location) + '\n')
+                elif latest_backup.get('storage') == 'packed':
+                    batch_file.write(extract_command(latest_backup, destination_location) + '\n')
+                elif latest_backup.get('compression'):
+                    batch_file.write(decompress_command(latest_backup, destination_location) + '\n')
+                else:
+                    batch_file.write(f'copy "{backup_file}" "{destination_location}"\n')
                 batch_file.write(f'if errorlevel 1 (\n')
                 batch_file.write(f'    echo Restoring {destination_location} failed with exit code: %errorlevel%\n)\n')
                 batch_file.write('echo -n .\n')
@@ -126,26 +284,128 @@ def generate_windows_restore_script(backup_info, batch_file_path, home_dir, rest
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Restore the latest version of each backed up file.")
+    parser.add_argument('--at', type=parse_point_in_time, metavar='WHEN',
+                        help="restore the files as they were at a backup run or date and time "
+                             "(e.g. 2023-09-18_09h44m37s or '2023-09-18 09:44'), leaving out files deleted by then")
+    parser.add_argument('--path', metavar='PATH',
+                        help="only restore this file or directory (relative to home_dir, or absolute)")
+    parser.add_argument('--script', action='store_true',
+                        help="generate a restore script instead of restoring the files directly")
+    parser.add_argument('--workers', type=int, default=restore_workers,
+                        help="number of threads copying files (default: restore_workers from the configuration)")
+    parser.add_argument('--verify-existing', action='store_true',
+                        help="check the hash of files left by an interrupted restore before skipping them")
+    parser.add_argument('--yes', action='store_true', help="do not ask for confirmation")
+    parser.add_argument('--reassemble', nargs=2, metavar=('MANIFEST', 'DESTINATION'),
+                        help="rebuild a chunked backup file from its manifest (used by the restore scripts)")
+    parser.add_argument('--extract', nargs=4, metavar=('PACK', 'OFFSET', 'LENGTH', 'DESTINATION'),
+                        help="copy a small file out of a pack file (used by the restore scripts)")
+    parser.add_argument('--decompress', nargs=3, metavar=('CODEC', 'BACKUP', 'DESTINATION'),
+                        help="decompress a compressed backup file (used by the restore scripts)")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile the run with cProfile and save the statistics in the backup base directory")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="trace memory allocations with tracemalloc and print the peak and top allocations")
+    args = parser.parse_args()
+
+    # Check if backup directory exists and has necessary permissions
+    if not check_directory(backup_base_dir, write=True):
+        print("Please check backup base directory path and write permissions.")
+        logging.error("Error: Backup base directory path or write permissions are invalid.")
+        exit(1)
+
+    configure_logging(backup_base_dir)
+
+    if args.reassemble:
+        reassemble_file(backup_base_dir, *args.reassemble)
+        sys.exit(0)
+    if args.extract:
+        pack_file, pack_offset, pack_length, destination_location = args.extract
+        extract_member(pack_file, int(pack_offset), int(pack_length), destination_location)
+        sys.exit(0)
+    if args.decompress:
+        decompress_file(*args.decompress)
+        sys.exit(0)
+
+    profile_prefix = os.path.join(backup_base_dir, time.strftime("restore_profile_%Y-%m-%d_%Hh%Mm%Ss"))
+    metrics = RunMetrics()
+    with profiled(profile_prefix, args.profile, args.trace_memory):
+        path = os.path.normpath(os.path.join(home_dir, args.path)) if args.path else None
+        if args.at or path:
+            # Point-in-time and selective restores only read the catalog rows of the files they restore
+            with metrics.phase('catalog'):
+                date_time, versions = list_backups_at(backup_base_dir, args.at, path, args.script,
+                                                      verify_workers, verify_bandwidth_limit)
+            if not versions:
+                print("No backed up files found" + (f" at {args.at}." if args.at else "."))
+                sys.exit(0)
+            print(f"Restoring {len(versions)} files as of the backup run of {date_time}"
+                  + (f", from {path}" if path else ""))
+
+            if args.script:
+                backup_info = dict((source_location, [backup]) for source_location, backup in versions)
+                if str(os.name) == 'nt':
+                    script_file_path = os.path.join(backup_base_dir, "restore_backup.bat")
+                    generate_windows_restore_script(backup_info, script_file_path, home_dir, restore_dir)
+                else:
+                    script_file_path = os.path.join(backup_base_dir, "restore_backup.sh")
+                    generate_restore_script(backup_info, script_file_path, home_dir, restore_dir)
+                sys.exit(0)
+
+            if not args.yes:
+                choice = input(f"Are you sure you want to restore files into {restore_dir}? (Y/N) ")
+                if choice.strip().lower() != 'y':
+                    print("Operation aborted.")
+                    sys.exit(1)
+            counts = restore_files(versions, backup_base_dir, home_dir, restore_dir, args.workers,
+                                   args.verify_existing, metrics)
+            logging.info(f"Restore into {restore_dir} as of {date_time}" + (f" from {path}" if path else "")
+                         + f": {counts['restored']} restored, {counts['skipped']} skipped, {counts['failed']} failed")
+            append_metrics_log(backup_base_dir, metrics.summary(kind='restore', restore_dir=restore_dir,
+                                                                date_time=date_time, path=path, **counts))
+            sys.exit(1 if counts['failed'] else 0)
+
+        if not args.script:
+            # Restore directly; hashes are checked as each file is copied, so they are not checked up front
+            with metrics.phase('catalog'):
+                backup_info, backup_times = list_all_backups(backup_base_dir, False)
+            if not backup_info:
+                print("No backup information found.")
+                sys.exit(0)
+            if not args.yes:
+                choice = input(f"Are you sure you want to restore files into {restore_dir}? (Y/N) ")
+                if choice.strip().lower() != 'y':
+                    print("Operation aborted.")
+                    sys.exit(1)
+            counts = restore_files(select_latest_versions(backup_info), backup_base_dir, home_dir, restore_dir,
+                                   args.workers, args.verify_existing, metrics)
+            logging.info(f"Restore into {restore_dir}: {counts['restored']} restored, {counts['skipped']} skipped, "
+                         f"{counts['failed']} failed")
+            append_metrics_log(backup_base_dir, metrics.summary(kind='restore', restore_dir=restore_dir, **counts))
+            sys.exit(1 if counts['failed'] else 0)
 
-    # Specify the full path to the output file within the backup base directory
-    output_file = os.path.join(backup_base_dir, "backup_info.txt")
+        # Specify the full path to the output file within the backup base directory
+        output_file = os.path.join(backup_base_dir, "backup_info.txt")
 
-    # Check if the output file already exists and delete it if it does
-    if os.path.exists(output_file):
-        os.remove(output_file)
+        # Check if the output file already exists and delete it if it does
+        if os.path.exists(output_file):
+            os.remove(output_file)
 
-    # Get backup info and check file hashes
-    backup_info, backup_times = list_all_backups(backup_base_dir, True)
+        # Get backup info and check file hashes
+        with metrics.phase('verify'):
+            backup_info, backup_times = list_all_backups(backup_base_dir, True, verify_workers,
+                                                         verify_bandwidth_limit, verify_latest_only)
 
-    if not backup_info:
-        print("No backup information found.")
-    else:
-        print_and_save_backup_info(backup_info, output_file)
+        if not backup_info:
+            print("No backup information found.")
+        else:
+            print_and_save_backup_info(backup_info, output_file)
 
-    # Specify the full path to the script within the backup base directory
-    if str(os.name) == 'nt':
-        script_file_path = os.path.join(backup_base_dir, "restore_backup.bat")
-        generate_windows_restore_script(backup_info, script_file_path, home_dir, restore_dir)
-    else:
-        script_file_path = os.path.join(backup_base_dir, "restore_backup.sh")
-        generate_restore_script(backup_info, script_file_path, home_dir, restore_dir)
+        # Specify the full path to the script within the backup base directory
+        if str(os.name) == 'nt':
+            script_file_path = os.path.join(backup_base_dir, "restore_backup.bat")
+            generate_windows_restore_script(backup_info, script_file_path, home_dir, restore_dir)
+        else:
+            script_file_path = os.path.join(backup_base_dir, "restore_backup.sh")
+            generate_restore_script(backup_info, script_file_path, home_dir, restore_dir)
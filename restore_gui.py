@@ -1,18 +1,31 @@
-from guizero import App, Box, Text
+from guizero import App, Box, Text, TextBox, PushButton, CheckBox
 app = 0
+controls_box = 0
 table_box = 0
 
+# Number of files (rows) and backup runs (columns) shown at a time
+PAGE_SIZE = 25
+VISIBLE_SNAPSHOTS = 8
+
 def create_window():
-    global app, table_box
+    global app, controls_box, table_box
     # Create an application
-    app = App("Backup Info Table", width=600, height=400)
+    app = App("Backup Info Table", width=900, height=700)
+
+    # Create a Box for the search and paging controls, above the table
+    controls_box = Box(app, layout="grid")
 
     # Create a Box widget to hold the table-like structure
     table_box = Box(app, layout="grid")
 
 # Function to make the backup table - one row per source file
+# The first row holds the column headings. Each other row is the source file and a dictionary of
+# column index (into backup_times) -> cell: "1" if the backup file's hash matched, "?" if not checked.
+# Each version is put in its column with one lookup of its run, so the time taken grows with the number
+# of versions, and runs that did not back up a file take no space in its row.
 def make_backup_table(backup_info, backup_times):
     table = [] # List for function output
+    snapshot_index = dict((time_str, col) for col, time_str in enumerate(backup_times))
 
     # Generate reformatted column headings
     row_data = ["Source File"]
@@ -24,42 +37,128 @@ def make_backup_table(backup_info, backup_times):
 
     # Generate the table rows, with one source file per row
     for source_location, backups in backup_info.items():
-        row_data = [source_location]
-        # Iterate through the table columns
-        for _, time_str in enumerate(backup_times, start=1):
-            cell_data = ""
-            for _, backup in enumerate(backups): # Get info on each backup file
-                backup_file = backup['backup_file']
-                if time_str in backup_file:
-                    cell_data = "1" if backup['hash_match'] else "?" # backup file found
-                    break
-            row_data.append(cell_data)
-
-        table.append(row_data)
+        cells = {}
+        for backup in backups: # Get info on each backup file
+            col = snapshot_index.get(backup['date_time'])
+            if col is not None and col not in cells:
+                cells[col] = "1" if backup['hash_match'] else "?" # backup file found
+        table.append((source_location, cells))
 
     return table
 
+# Class to show a page of the backup table at a time
+# The Text widgets for one page are created once and their values replaced when the page changes, so the
+# window stays responsive however many files and backup runs there are. Rows can be filtered by a search
+# text in the source path and to files with unchecked backups; columns show a window of the backup runs,
+# starting with the latest.
+class BackupTableView:
+    def __init__(self, controls_box, table_box, backup_table, page_size=PAGE_SIZE,
+                 visible_snapshots=VISIBLE_SNAPSHOTS):
+        self.headings = backup_table[0]
+        self.rows = backup_table[1:]
+        self.matches = self.rows
+        self.page_size = page_size
+        self.visible_snapshots = min(visible_snapshots, len(self.headings) - 1)
+        self.page = 0
+        self.first_snapshot = len(self.headings) - 1 - self.visible_snapshots
+
+        # Search and paging controls
+        Text(controls_box, "Search:", grid=[0, 0], align="left")
+        self.search_box = TextBox(controls_box, width=40, grid=[1, 0])
+        PushButton(controls_box, text="Search", command=self.apply_filter, grid=[2, 0])
+        self.unchecked_only = CheckBox(controls_box, text="Unchecked only", command=self.apply_filter, grid=[3, 0])
+        PushButton(controls_box, text="< Prev", command=self.previous_page, grid=[0, 1])
+        PushButton(controls_box, text="Next >", command=self.next_page, grid=[1, 1])
+        PushButton(controls_box, text="< Older", command=self.older_snapshots, grid=[2, 1])
+        PushButton(controls_box, text="Newer >", command=self.newer_snapshots, grid=[3, 1])
+        self.status = Text(controls_box, "", grid=[0, 2, 4, 1], align="left")
+
+        # One Text widget per visible cell, left-justifying the text in the first column
+        self.cells = []
+        for row in range(self.page_size + 1):
+            self.cells.append([Text(table_box, "", grid=[col, row], align="left" if col == 0 else "right")
+                               for col in range(self.visible_snapshots + 1)])
+        self.render()
+
+    # Function to keep only the rows matching the search text (and unchecked backups, if ticked)
+    def apply_filter(self):
+        search = self.search_box.value.strip().lower()
+        unchecked_only = self.unchecked_only.value
+        self.matches = [row for row in self.rows
+                        if (not search or search in row[0].lower())
+                        and (not unchecked_only or "?" in row[1].values())]
+        self.page = 0
+        self.render()
+
+    def previous_page(self):
+        if self.page > 0:
+            self.page -= 1
+            self.render()
+
+    def next_page(self):
+        if (self.page + 1) * self.page_size < len(self.matches):
+            self.page += 1
+            self.render()
+
+    def older_snapshots(self):
+        if self.first_snapshot > 0:
+            self.first_snapshot = max(0, self.first_snapshot - self.visible_snapshots)
+            self.render()
+
+    def newer_snapshots(self):
+        last_first = len(self.headings) - 1 - self.visible_snapshots
+        if self.first_snapshot < last_first:
+            self.first_snapshot = min(last_first, self.first_snapshot + self.visible_snapshots)
+            self.render()
+
+    # Function to show the current page in the existing widgets
+    def render(self):
+        columns = range(self.first_snapshot, self.first_snapshot + self.visible_snapshots)
+        header = self.cells[0]
+        header[0].value = self.headings[0]
+        for i, col in enumerate(columns, start=1):
+            header[i].value = self.headings[col + 1]
+
+        start = self.page * self.page_size
+        page_rows = self.matches[start:start + self.page_size]
+        for row_cells, row in zip(self.cells[1:], page_rows):
+            source_location, cells = row
+            row_cells[0].value = source_location
+            for i, col in enumerate(columns, start=1):
+                row_cells[i].value = cells.get(col, "")
+        for row_cells in self.cells[1 + len(page_rows):]:
+            for cell in row_cells:
+                cell.value = ""
+
+        num_pages = max(1, (len(self.matches) + self.page_size - 1) // self.page_size)
+        self.status.value = (f"Files {start + 1 if page_rows else 0}-{start + len(page_rows)} of {len(self.matches)} "
+                             f"(page {self.page + 1} of {num_pages}), backups {self.first_snapshot + 1}-"
+                             f"{self.first_snapshot + self.visible_snapshots} of {len(self.headings) - 1}")
+
 # Function to display the backup table
 def display_backup_table(backup_table):
-    global app, table_box
+    global app, controls_box, table_box
     if backup_table == []:
         return # nothing to display
 
-    num_rows = len(backup_table)
-    num_cols = len(backup_table[0])
-    row = 0
-
-    while row < num_rows:
-        if row > 10:
-            break # Display only the first 10 files
-        col = 0
-        while col < num_cols:
-            # Left-justify the text in the first column
-            justify = "left" if col == 0 else "right"
-            text = backup_table[row][col]
-            Text(table_box, text, grid=[col, row+1], align=justify)
-            col += 1
-        row += 1
+    BackupTableView(controls_box, table_box, backup_table)
 
     # Display the guizero application
-    app.display()
\ No newline at end of file
+    app.display()
+
+
+if __name__ == "__main__":
+    import os
+    from backup import list_all_backups
+
+    # Import the configuration
+    if str(os.name) == 'nt':
+        from backup_config_windows import backup_base_dir, verify_workers, verify_bandwidth_limit, verify_latest_only
+    else:
+        from backup_config import backup_base_dir, verify_workers, verify_bandwidth_limit, verify_latest_only
+
+    # Files verified before and unchanged since are not read again
+    backup_info, backup_times = list_all_backups(backup_base_dir, True, verify_workers, verify_bandwidth_limit,
+                                                 verify_latest_only)
+    create_window()
+    display_backup_table(make_backup_table(backup_info, backup_times))